@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+# Навантажувальний тест бота без мережі: справжній Application з усіма обробниками працює проти
+# локальної заглушки Telegram Bot API та заглушки OpenWeatherMap із налаштовуваною затримкою й збоями.
+# Оновлення йдуть через update_queue запущеного застосунку (з тим самим concurrent_updates, що й у роботі),
+# а розсилку запускає справжнє завдання планувальника notify_tick на лідері
+# Запуск: python benchmark.py --users 200 --storm-users 5000 --output benchmark.json
+
+BENCH_TOKEN = "123456:benchmark"
+# Найменший запас часу до слоту шторму: підписники мають бути записані до спрацювання notify_tick
+STORM_LEAD_SECONDS = 10
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Weather", "username": "weather_bench_bot"}
+
+
+# Мінімальний HTTP/1.1-сервер з keep-alive: handler(method, path, query, body) -> (status, dict)
+class StubServer:
+    def __init__(self, handler, latency=0.0, fault_rate=0.0):
+        self.handler = handler
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.calls = Counter()
+        self.faults = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b""
+                url = urlsplit(target)
+                if self.latency:
+                    await asyncio.sleep(random.expovariate(1 / self.latency))
+                if self.fault_rate and random.random() < self.fault_rate:
+                    self.faults += 1
+                    status, payload = 503, {"cod": 503, "message": "injected fault"}
+                else:
+                    status, payload = self.handler(method, url.path, parse_qs(url.query), body)
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# Заглушка Telegram Bot API: рахує виклики методів і повертає правдоподібні відповіді
+def make_telegram_stub(latency):
+    message_ids = iter(range(1, 1 << 62))
+    stub = StubServer(None, latency)
+
+    def handler(method, path, query, body):
+        api_method = path.rsplit("/", 1)[-1]
+        stub.calls[api_method] += 1
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("answerCallbackQuery", "setWebhook", "deleteWebhook"):
+            result = True
+        else:
+            result = {"message_id": next(message_ids), "date": int(time.time()),
+                      "chat": {"id": 1, "type": "private"}, "from": BOT_USER, "text": ""}
+            if api_method == "sendMediaGroup":
+                result = [result]
+        return 200, {"ok": True, "result": result}
+
+    stub.handler = handler
+    return stub
+
+
+# Заглушка OpenWeatherMap: набір синтетичних міст, поточна погода і прогноз на 40 точок
+def make_owm_stub(city_count, latency, fault_rate):
+    cities = {i: (100000 + i, f"Місто {i}", 20 + 15 * math.sin(i)) for i in range(city_count)}
+    by_name = {city[1].casefold(): city for city in cities.values()}
+    by_id = {city[0]: city for city in cities.values()}
+    stub = StubServer(None, latency, fault_rate)
+
+    def handler(method, path, query, body):
+        endpoint = path.rsplit("/", 1)[-1]
+        if "q" in query:
+            city = by_name.get(" ".join(query["q"][0].split()).casefold())
+            stub.calls[endpoint + "_lookup"] += 1
+        else:
+            city = by_id.get(int(query.get("id", ["0"])[0]))
+            stub.calls[endpoint] += 1
+        if city is None:
+            return 404, {"cod": "404", "message": "city not found"}
+        city_id, name, temp = city
+        now = int(time.time())
+        if endpoint == "weather":
+            return 200, {"id": city_id, "name": name, "coord": {"lat": 50.0, "lon": 30.0}, "dt": now,
+                         "timezone": 7200, "main": {"temp": temp, "temp_min": temp - 2, "temp_max": temp + 2,
+                                                    "humidity": 60},
+                         "wind": {"speed": 4.0}, "weather": [{"id": 800, "description": "ясно"}]}
+        points = [{"dt": now - now % 10800 + i * 10800,
+                   "main": {"temp": temp + 5 * math.sin(i / 8 * 2 * math.pi), "temp_min": temp - 5,
+                            "temp_max": temp + 5, "humidity": 70},
+                   "wind": {"speed": 3.0}, "rain": {"3h": 0.4} if i % 7 == 0 else {},
+                   "weather": [{"id": 500 if i % 7 == 0 else 801, "description": "легкий дощ" if i % 7 == 0 else "хмарно"}]}
+                  for i in range(40)]
+        return 200, {"list": points, "city": {"id": city_id, "name": name, "timezone": 7200}}
+
+    stub.handler = handler
+    return stub, [city[1] for city in cities.values()]
+
+
+# Синтетичні оновлення Telegram
+def user_json(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def message_update(update_id, user_id, text):
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user_json(user_id), "text": text}
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id, user_id, data):
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": BOT_USER, "text": "Виберіть тип прогнозу:"}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user_json(user_id),
+                                                       "chat_instance": str(user_id), "data": data,
+                                                       "message": message}}
+
+
+def percentiles(samples):
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    p50, p95, p99 = np.percentile(np.array(samples) * 1000, (50, 95, 99))
+    return {"p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2)}
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+# Сценарій одного користувача: кілька міст -> "Погода зараз", кілька міст -> "Прогноз", /compare.
+# Користувач чекає на відповідь перед наступним оновленням
+async def run_user(application, Update, user_id, names, args, ids, latencies, done):
+    rng = random.Random(user_id)
+    for _ in range(args.rounds):
+        for button in ("current", "forecast"):
+            text = ", ".join(rng.sample(names, args.cities_per_message))
+            for kind, payload in (("message", message_update(next(ids), user_id, text)),
+                                  (button, callback_update(next(ids), user_id, button))):
+                await process(application, Update, payload, kind, latencies, done)
+        compare = "/compare " + ", ".join(rng.sample(names, min(3, len(names))))
+        await process(application, Update, message_update(next(ids), user_id, compare), "compare",
+                      latencies, done)
+
+
+# Оновлення ставиться в update_queue; затримка — від постановки до завершення обробника
+# (done[update_id] завершує обробник у групі 1, що виконується після основного)
+async def process(application, Update, payload, kind, latencies, done):
+    update = Update.de_json(payload, application.bot)
+    future = done[update.update_id] = asyncio.get_running_loop().create_future()
+    started = time.perf_counter()
+    await application.update_queue.put(update)
+    latencies.setdefault(kind, []).append(await future - started)
+
+
+def completion_handler(done):
+    async def callback(update, context):
+        future = done.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+    return callback
+
+
+# Перша межа хвилини, до якої лишається не менше lead секунд
+def next_slot(lead):
+    return (datetime.now() + timedelta(seconds=lead, minutes=1)).replace(second=0, microsecond=0)
+
+
+# Майбутнє, що завершується, коли notify_tick відпрацює для слоту slot_at
+def wait_for_tick(scheduler, slot_at):
+    from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+    loop = asyncio.get_running_loop()
+    fired = loop.create_future()
+
+    def listener(event):
+        if event.job_id == "notify_tick" and event.scheduled_run_time.timestamp() >= slot_at.timestamp():
+            loop.call_soon_threadsafe(lambda: fired.done() or fired.set_result(event.exception))
+
+    scheduler.add_listener(listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+    fired.add_done_callback(lambda _: scheduler.remove_listener(listener))
+    return fired
+
+
+async def main(args):
+    telegram_stub = make_telegram_stub(args.tg_latency)
+    owm_stub, names = make_owm_stub(args.cities, args.owm_latency, args.owm_fault_rate)
+    telegram_port = await telegram_stub.start()
+    owm_port = await owm_stub.start()
+
+    # Налаштування читаються модулями бота під час імпорту, тому бот імпортується вже після запуску заглушок.
+    # Ліміти відправлення й квоту API піднято, щоб вимірювати сам бот (їх можна перевизначити змінними середовища)
+    data_dir = tempfile.mkdtemp(prefix="weather-bench-")
+    os.environ["DB_PATH"] = os.path.join(data_dir, "bench.db")
+    os.environ["OWM_BASE_URL"] = f"http://127.0.0.1:{owm_port}"
+    for name, value in (("SEND_GLOBAL_RATE", "100000"), ("SEND_CHAT_RATE", "100000"),
+                        ("SEND_CHAT_BURST", "100000"), ("OWM_CALLS_PER_MINUTE", "100000000"),
+                        ("OWM_CALLS_PER_DAY", "100000000")):
+        os.environ.setdefault(name, value)
+    weather_bot = importlib.import_module("weather_bot")
+    storage = importlib.import_module("storage")
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    # Запуск як у main(): розклад, post_init (клієнти, оренда лідера, планувальник) і обробка update_queue
+    storage.init_db.blocking()
+    application = weather_bot.build_application(BENCH_TOKEN, base_url=f"http://127.0.0.1:{telegram_port}/bot")
+    done = {}
+    application.add_handler(TypeHandler(Update, completion_handler(done)), group=1)
+    weather_bot.load_scheduled_jobs(application)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    results = {"config": {**vars(args), "concurrent_updates": application.concurrent_updates},
+               "started_at": datetime.now().isoformat(timespec="seconds"), "phases": {}}
+
+    # Фаза 1: інтерактивний трафік
+    latencies = {}
+    ids = iter(range(1, 1 << 62))
+    owm_before, telegram_before = Counter(owm_stub.calls), Counter(telegram_stub.calls)
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(application, Update, user_id, names, args, ids, latencies, done)
+                           for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(samples) for samples in latencies.values())
+    results["phases"]["interactive"] = {
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1) if elapsed else None,
+        "latency": percentiles([sample for samples in latencies.values() for sample in samples]),
+        "latency_by_kind": {kind: {"count": len(samples), **percentiles(samples)}
+                            for kind, samples in sorted(latencies.items())},
+        "owm_calls": dict(owm_stub.calls - owm_before),
+        "telegram_calls": dict(telegram_stub.calls - telegram_before),
+    }
+
+    # Фаза 2: шторм оповіщень для storm_users підписників найближчого слоту; розсилку запускає планувальник
+    if args.storm_users:
+        city_index = importlib.import_module("cities").city_index
+        cities = [city for city in await asyncio.gather(*(city_index.resolve(name) for name in names)) if city]
+        for user_id in range(1_000_000, 1_000_000 + args.storm_users):
+            await storage.save_favorite_city(user_id, cities[user_id % len(cities)])
+        slot_at = next_slot(STORM_LEAD_SECONDS)
+        for user_id in range(1_000_000, 1_000_000 + args.storm_users):
+            await storage.save_notification_time(user_id, slot_at.strftime("%H:%M"))
+        fired = wait_for_tick(weather_bot.scheduler, slot_at)
+        await asyncio.sleep(max(0.0, (slot_at - datetime.now()).total_seconds()))
+        owm_before, telegram_before = Counter(owm_stub.calls), Counter(telegram_stub.calls)
+        started = time.perf_counter()
+        error = await asyncio.wait_for(fired, args.storm_timeout)
+        dispatched = time.perf_counter() - started
+        await weather_bot.outbox.close(timeout=args.storm_timeout)
+        elapsed = time.perf_counter() - started
+        sent = (telegram_stub.calls - telegram_before)["sendMessage"]
+        results["phases"]["notification_storm"] = {
+            "subscribers": args.storm_users,
+            "slot": slot_at.strftime("%H:%M"),
+            "leader": weather_bot.is_leader(),
+            "tick_error": repr(error) if error else None,
+            "dispatch_seconds": round(dispatched, 3),
+            "seconds": round(elapsed, 3),
+            "messages_sent": sent,
+            "messages_per_s": round(sent / elapsed, 1) if elapsed else None,
+            "owm_calls": dict(owm_stub.calls - owm_before),
+        }
+
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    await telegram_stub.close()
+    await owm_stub.close()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["owm_calls_total"] = dict(owm_stub.calls)
+    results["owm_faults_injected"] = owm_stub.faults
+    results["telegram_calls_total"] = dict(telegram_stub.calls)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Навантажувальний тест погодного бота з локальними заглушками")
+    parser.add_argument("--users", type=int, default=100, help="кількість користувачів")
+    parser.add_argument("--rounds", type=int, default=2, help="повторів сценарію на користувача")
+    parser.add_argument("--cities", type=int, default=50, help="кількість різних міст")
+    parser.add_argument("--cities-per-message", type=int, default=3, help="міст в одному повідомленні")
+    parser.add_argument("--owm-latency", type=float, default=0.05, help="середня затримка OpenWeatherMap, с")
+    parser.add_argument("--owm-fault-rate", type=float, default=0.0, help="частка відповідей 503 від OpenWeatherMap")
+    parser.add_argument("--tg-latency", type=float, default=0.01, help="середня затримка Telegram Bot API, с")
+    parser.add_argument("--storm-users", type=int, default=1000, help="підписників одного слоту оповіщень (0 — без шторму)")
+    parser.add_argument("--storm-timeout", type=float, default=300, help="найдовше очікування розсилки, с")
+    parser.add_argument("--output", default="benchmark.json", help="файл результатів JSON")
+    args = parser.parse_args()
+    args.cities_per_message = min(args.cities_per_message, args.cities)
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,76 @@
+import asyncio
+import io
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Пул потоків для малювання графіків і розмір кешу готових зображень
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 2))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 128))
+
+_executor = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix="chart")
+_cache = OrderedDict()
+_inflight = {}
+_stats = {"hits": 0, "misses": 0}
+
+
+# Малювання графіка температури в PNG; matplotlib імпортується лише при першому графіку.
+# Використовується об'єктний API Figure/Agg без глобального стану pyplot, тому він безпечний у потоках
+@metrics.timed("chart_render_seconds")
+def _render_temperature_chart(city, times, temps):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.dates import DateFormatter, DayLocator
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 4))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.plot(times, temps, marker='o', markersize=3, color='#3498db', label=f'Температура в {city} (°C)')
+    ax.fill_between(times, temps, color='#3498db', alpha=0.2)
+    ax.xaxis.set_major_locator(DayLocator())
+    ax.xaxis.set_major_formatter(DateFormatter('%m-%d'))
+    ax.set_title(f'Прогноз температури в {city}')
+    ax.set_xlabel('Дата')
+    ax.set_ylabel('Температура (°C)')
+    ax.legend()
+    ax.grid(True)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+
+# Графік температури за 3-годинними точками (times — місцевий час міста):
+# PNG-байти з кешу або з пулу потоків; однакові прогнози малюються один раз
+async def get_temperature_chart(times, temps, city, forecast_ts):
+    key = (city, forecast_ts, tuple(temps))
+    png = _cache.get(key)
+    if png is not None:
+        _stats["hits"] += 1
+        _cache.move_to_end(key)
+        return png
+    _stats["misses"] += 1
+    future = _inflight.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_executor, _render_temperature_chart, city, list(times), list(temps))
+        _inflight[key] = future
+        try:
+            png = await asyncio.shield(future)
+        finally:
+            _inflight.pop(key, None)
+        _cache[key] = png
+        while len(_cache) > CHART_CACHE_SIZE:
+            _cache.popitem(last=False)
+        return png
+    return await asyncio.shield(future)
+
+
+def _hit_ratio():
+    lookups = _stats["hits"] + _stats["misses"]
+    return _stats["hits"] / lookups if lookups else 0.0
+
+
+metrics.gauge("chart_cache_hit_ratio", "Частка графіків, узятих з кешу", _hit_ratio)
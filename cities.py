@@ -0,0 +1,79 @@
+import asyncio
+import os
+import time
+
+import storage
+from models import City
+from weather_client import weather_client, normalize_city, WeatherClientError
+
+# Скільки часу пам'ятати, що назву не вдалося знайти (щоб не повторювати запити до API)
+NOT_FOUND_TTL = float(os.getenv("CITY_NOT_FOUND_TTL", 3600))
+
+
+# Індекс міст: варіанти назв -> канонічне місто OpenWeatherMap (id, назва, координати).
+# Пошук іде по нормалізованій назві в пам'яті; до API звертаємось лише при промаху,
+# а результат зберігається в SQLite, тож переживає перезапуск
+class CityIndex:
+    def __init__(self):
+        self._by_alias = {}
+        self._by_id = {}
+        self._not_found = {}
+        self._inflight = {}
+
+    async def load(self):
+        cities, aliases = await storage.load_city_index()
+        self._by_id = {city.id: city for city in cities}
+        self._by_alias = {alias: self._by_id[city_id] for alias, city_id in aliases if city_id in self._by_id}
+
+    # Місто за введеною назвою або None, якщо такого міста немає чи API недоступний
+    # (interactive=False — фоновий запит, обмежений фоновою часткою квоти API)
+    async def resolve(self, name, interactive=True):
+        alias = normalize_city(name)
+        city = self._by_alias.get(alias)
+        if city is not None:
+            return city
+        if self._not_found.get(alias, 0) > time.monotonic():
+            return None
+        task = self._inflight.get(alias)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(name, alias, interactive))
+            self._inflight[alias] = task
+            task.add_done_callback(lambda _: self._inflight.pop(alias, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, name, alias, interactive):
+        # Місто могло бути додане іншим процесом бота зі спільною базою
+        city = await storage.find_city_by_alias(alias)
+        if city is not None:
+            self._by_id[city.id] = city
+            self._by_alias[alias] = city
+            return city
+        try:
+            conditions = await weather_client.lookup(name, interactive=interactive)
+        except WeatherClientError as e:
+            if e.status == 404:
+                now = time.monotonic()
+                if len(self._not_found) > 10000:
+                    self._not_found = {key: expires for key, expires in self._not_found.items() if expires > now}
+                self._not_found[alias] = now + NOT_FOUND_TTL
+            return None
+        city = self._by_id.get(conditions.city_id)
+        if city is None:
+            city = City(conditions.city_id, conditions.name or name.strip().title(), conditions.lat, conditions.lon)
+        aliases = {alias, normalize_city(city.name)}
+        await storage.save_city(city, aliases)
+        self._by_id[city.id] = city
+        for known in aliases:
+            self._by_alias[known] = city
+        return city
+
+    # Розпізнавання старих улюблених міст, збережених лише за назвою (на лідері при старті й щогодини,
+    # доки всі назви не отримають id)
+    async def backfill_favorites(self):
+        for name in await storage.get_unresolved_favorite_names():
+            city = await self.resolve(name, interactive=False)
+            if city is not None:
+                await storage.resolve_favorite_city(name, city)
+
+
+city_index = CityIndex()
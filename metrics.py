@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import functools
+import os
+import threading
+import time
+
+# Метрики у форматі Prometheus; вимкнені за замовчуванням, тоді декоратори повертають функції без змін
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+
+# Межі кошиків гістограм (секунди)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Опис відомих метрик для рядків HELP
+HELP = {
+    "owm_request_seconds": "Тривалість запиту до OpenWeatherMap за типом запиту",
+    "sqlite_query_seconds": "Тривалість функцій storage у потоці SQLite",
+    "chart_render_seconds": "Тривалість малювання графіка",
+    "telegram_send_seconds": "Тривалість виклику Telegram Bot API з черги відправлення",
+    "handler_seconds": "Повна тривалість обробки оновлення за обробником",
+    "job_seconds": "Тривалість запланованого завдання",
+    "scheduler_job_lag_seconds": "Запізнення запуску запланованого завдання відносно розкладу",
+}
+
+_histograms = {}
+_gauges = {}
+_registry_lock = threading.Lock()
+_server = None
+_NOOP = contextlib.nullcontext()
+
+
+# Гістограма з довільними мітками; спостереження можуть надходити з різних потоків
+class Histogram:
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self._series = {}  # labels -> [counts по кошиках, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {HELP.get(self.name, self.name)}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(snapshot):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _histogram(name):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _registry_lock:
+            histogram = _histograms.setdefault(name, Histogram(name))
+    return histogram
+
+
+# Записати одне значення в гістограму
+def observe(name, value, **labels):
+    if METRICS_ENABLED:
+        _histogram(name).observe(value, tuple(sorted(labels.items())))
+
+
+# Показник, що обчислюється під час збору метрик: collect() повертає число
+def gauge(name, help, collect):
+    if METRICS_ENABLED:
+        _gauges[name] = (help, collect)
+
+
+# Менеджер контексту, що вимірює тривалість блоку (при вимкнених метриках — порожній)
+def timer(name, **labels):
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Timer(_histogram(name), tuple(sorted(labels.items())))
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        return False
+
+
+# Декоратор для звичайних і асинхронних функцій (при вимкнених метриках повертає функцію без змін)
+def timed(name, **labels):
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        histogram = _histogram(name)
+        key = tuple(sorted(labels.items()))
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, key)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, key)
+        return wrapper
+    return decorator
+
+
+# Текст сторінки /metrics
+def render():
+    lines = []
+    for name in sorted(_histograms):
+        lines.extend(_histograms[name].render())
+    for name, (help, collect) in sorted(_gauges.items()):
+        try:
+            value = float(collect())
+        except Exception:
+            continue
+        lines.extend((f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"))
+    return "\n".join(lines) + "\n"
+
+
+# Мінімальний HTTP-сервер на циклі бота: GET /metrics, решта — 404
+async def _handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", render().encode()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not Found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    global _server
+    if METRICS_ENABLED and _server is None:
+        _server = await asyncio.start_server(_handle, host, port)
+
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,207 @@
+from dataclasses import dataclass
+from datetime import date, time, timedelta
+
+import numpy as np
+
+
+# Модель даних погоди: відповіді OpenWeatherMap розбираються один раз,
+# далі текст, графіки, сповіщення й порівняння працюють з цими об'єктами.
+# __slots__ задано вручну, бо dataclass(slots=True) з'явився лише в Python 3.10
+
+# Місто з ідентифікатором OpenWeatherMap (id може бути None для ще не розпізнаних старих записів)
+@dataclass(frozen=True)
+class City:
+    __slots__ = ("id", "name", "lat", "lon")
+    id: int
+    name: str
+    lat: float
+    lon: float
+
+
+# Поточна погода в місті
+@dataclass(frozen=True)
+class CurrentConditions:
+    __slots__ = ("city_id", "name", "lat", "lon", "observed_at", "timezone_offset", "temp", "temp_min",
+                 "temp_max", "humidity", "wind_speed", "condition_code", "description", "fetched_at")
+    city_id: int
+    name: str
+    lat: float
+    lon: float
+    observed_at: int
+    timezone_offset: int
+    temp: float
+    temp_min: float
+    temp_max: float
+    humidity: int
+    wind_speed: float
+    condition_code: int
+    description: str
+    fetched_at: int
+
+    @classmethod
+    def from_owm(cls, data, fetched_at=0):
+        main = data["main"]
+        weather = data["weather"][0]
+        coord = data.get("coord", {})
+        return cls(
+            city_id=data.get("id", 0),
+            name=data.get("name", ""),
+            lat=coord.get("lat"),
+            lon=coord.get("lon"),
+            observed_at=data.get("dt", 0),
+            timezone_offset=data.get("timezone", 0),
+            temp=main["temp"],
+            temp_min=main["temp_min"],
+            temp_max=main["temp_max"],
+            humidity=main["humidity"],
+            wind_speed=data["wind"]["speed"],
+            condition_code=weather["id"],
+            description=weather["description"],
+            fetched_at=fetched_at,
+        )
+
+
+# Одна 3-годинна точка прогнозу
+@dataclass(frozen=True)
+class ForecastPoint:
+    __slots__ = ("ts", "temp", "temp_min", "temp_max", "humidity", "wind_speed",
+                 "precipitation", "condition_code", "description")
+    ts: int
+    temp: float
+    temp_min: float
+    temp_max: float
+    humidity: int
+    wind_speed: float
+    precipitation: float
+    condition_code: int
+    description: str
+
+    @classmethod
+    def from_owm(cls, item):
+        main = item["main"]
+        weather = item["weather"][0]
+        return cls(
+            ts=item["dt"],
+            temp=main["temp"],
+            temp_min=main["temp_min"],
+            temp_max=main["temp_max"],
+            humidity=main["humidity"],
+            wind_speed=item["wind"]["speed"],
+            precipitation=item.get("rain", {}).get("3h", 0.0) + item.get("snow", {}).get("3h", 0.0),
+            condition_code=weather["id"],
+            description=weather["description"],
+        )
+
+
+# Прогноз для міста: усі 3-годинні точки
+@dataclass(frozen=True)
+class Forecast:
+    __slots__ = ("city_id", "name", "timezone_offset", "points", "fetched_at")
+    city_id: int
+    name: str
+    timezone_offset: int
+    points: tuple
+    fetched_at: int
+
+    @classmethod
+    def from_owm(cls, data, fetched_at=0):
+        city = data.get("city", {})
+        return cls(
+            city_id=city.get("id", 0),
+            name=city.get("name", ""),
+            timezone_offset=city.get("timezone", 0),
+            points=tuple(ForecastPoint.from_owm(item) for item in data["list"]),
+            fetched_at=fetched_at,
+        )
+
+
+# Коди погоди з опадами, від яких рятує парасоля: гроза (2xx), мряка (3xx), дощ (5xx) і дощ зі снігом (611–616).
+# Одне визначення і для денного прапорця rainy, і для порад та емодзі в rendering
+def is_wet_code(code):
+    return code // 100 in (2, 3, 5) or 611 <= code <= 616
+
+
+WET_CODES = np.array([is_wet_code(code) for code in range(1000)])
+
+
+# Крок прогнозу OpenWeatherMap; день з повним набором точок охоплює 21 годину (8 точок)
+FORECAST_STEP = 3 * 3600
+FULL_DAY_SPAN = 86400 - FORECAST_STEP
+
+
+# Підсумок прогнозу за один місцевий календарний день; partial — день, що потрапив у прогноз лише частково
+# (зазвичай сьогодні й останній день), тоді first_point/last_point — місцевий час першої й останньої точки
+@dataclass(frozen=True)
+class DailySummary:
+    __slots__ = ("day", "temp_min", "temp_max", "temp_mean", "humidity", "precipitation", "wind_max",
+                 "condition_code", "description", "rainy", "first_point", "last_point", "partial")
+    day: date
+    temp_min: float
+    temp_max: float
+    temp_mean: float
+    humidity: float
+    precipitation: float
+    wind_max: float
+    condition_code: int
+    description: str
+    rainy: bool
+    first_point: time
+    last_point: time
+    partial: bool
+
+
+# Групування всіх 3-годинних точок за місцевими днями (з урахуванням часового поясу міста)
+# одним векторизованим проходом: справжні мін/макс/середня температура, сума опадів і пік вітру.
+# Опис дня береться з точки, найближчої до місцевого полудня
+def aggregate_daily(forecast):
+    points = forecast.points
+    if not points:
+        return []
+    values = np.array([(p.ts, p.temp, p.temp_min, p.temp_max, p.humidity, p.wind_speed,
+                        p.precipitation, p.condition_code) for p in points], dtype=np.float64)
+    local_ts = values[:, 0].astype(np.int64) + forecast.timezone_offset
+    days = local_ts // 86400
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    counts = np.diff(np.r_[starts, len(points)])
+    ends = starts + counts - 1
+    first_point = local_ts[starts] % 86400
+    last_point = local_ts[ends] % 86400
+    partial = last_point - first_point < FULL_DAY_SPAN
+
+    temp_min = np.minimum.reduceat(values[:, 2], starts)
+    temp_max = np.maximum.reduceat(values[:, 3], starts)
+    temp_mean = np.add.reduceat(values[:, 1], starts) / counts
+    humidity = np.add.reduceat(values[:, 4], starts) / counts
+    wind_max = np.maximum.reduceat(values[:, 5], starts)
+    precipitation = np.add.reduceat(values[:, 6], starts)
+    codes = values[:, 7].astype(np.int64)
+    # Коди поза 0–999 (їх у OpenWeatherMap немає) потрапляють на 0 чи 999 — обидва не «мокрі»
+    wet = WET_CODES[np.clip(codes, 0, 999)]
+    rainy = np.logical_or.reduceat(wet, starts)
+    noon_distance = np.abs(local_ts % 86400 - 43200)
+    representative = np.lexsort((noon_distance, days))[starts]
+
+    epoch = date(1970, 1, 1)
+    return [
+        DailySummary(
+            day=epoch + timedelta(days=int(days[start])),
+            temp_min=float(temp_min[i]),
+            temp_max=float(temp_max[i]),
+            temp_mean=float(temp_mean[i]),
+            humidity=float(humidity[i]),
+            precipitation=float(precipitation[i]),
+            wind_max=float(wind_max[i]),
+            condition_code=points[rep].condition_code,
+            description=points[rep].description,
+            rainy=bool(rainy[i]),
+            first_point=_time_of_day(first_point[i]),
+            last_point=_time_of_day(last_point[i]),
+            partial=bool(partial[i]),
+        )
+        for i, (start, rep) in enumerate(zip(starts, representative))
+    ]
+
+
+def _time_of_day(seconds):
+    seconds = int(seconds)
+    return time(seconds // 3600, seconds % 3600 // 60)
@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import itertools
+import os
+import time
+
+from telegram.error import RetryAfter
+
+import metrics
+
+# Ліміти Telegram: ~30 повідомлень/с загалом і ~1 повідомлення/с в одному чаті (з невеликим запасом на сплеск)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 28))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 5))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", 10000))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", 16))
+SEND_MAX_RETRIES = 3
+
+# Пріоритети: відповіді користувачам раніше за масові розсилки
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+# Відро токенів: rate токенів за секунду, не більше capacity
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Бере токен і повертає 0 або повертає, скільки секунд чекати до появи токена
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+# Черга вихідних повідомлень з обмеженням швидкості, пріоритетами та повтором після RetryAfter.
+# Повідомлення одного чату йдуть по черзі: поки одне в роботі, наступні чекають у черзі чату, не займаючи обробників
+class Outbox:
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 max_size=SEND_QUEUE_SIZE, workers=SEND_WORKERS):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_size = max_size
+        self.worker_count = workers
+        self._global = TokenBucket(global_rate, max(1.0, global_rate / 10))
+        self._chats = {}
+        self._chat_pending = {}  # chat_id -> deque наступних повідомлень; ключ є, поки в чату щось у роботі
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._queue = None
+        self._slots = None
+        self._idle = None
+        self._size = 0
+        self._workers = []
+
+    async def start(self):
+        if self._queue is None:
+            # Сама черга без межі (повторні постановки не мають чекати); розмір обмежує _slots
+            self._queue = asyncio.PriorityQueue()
+            self._slots = asyncio.Semaphore(self.max_size)
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    # Дочекатися відправлення вже поставлених повідомлень (не довше timeout) і зупинити обробників
+    async def close(self, timeout=10):
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._queue = None
+        self._workers = []
+        self._chat_pending.clear()
+        self._size = 0
+
+    # Кількість повідомлень, що ще не відправлені
+    def qsize(self):
+        return self._size
+
+    # Поставити виклик у чергу і дочекатися результату (помилки Telegram передаються далі)
+    async def submit(self, chat_id, send, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        await self._put(priority, chat_id, send, args, kwargs, future)
+        return await future
+
+    # Поставити виклик у чергу без очікування результату; при переповненій черзі чекає на місце
+    async def post(self, chat_id, send, *args, priority=PRIORITY_BATCH, **kwargs):
+        await self._put(priority, chat_id, send, args, kwargs, None)
+
+    async def _put(self, priority, chat_id, send, args, kwargs, future):
+        await self.start()
+        await self._slots.acquire()
+        self._size += 1
+        self._idle.clear()
+        self._queue.put_nowait((priority, next(self._seq), chat_id, send, args, kwargs, future, False))
+
+    # Повернути повідомлення в чергу як чергове для свого чату (з тим самим пріоритетом і порядковим номером)
+    def _requeue(self, queue, item):
+        if queue is self._queue:
+            queue.put_nowait(item[:-1] + (True,))
+
+    # Повідомлення оброблено: звільнити місце в черзі й поставити наступне повідомлення цього чату
+    def _done(self, chat_id):
+        self._slots.release()
+        self._size -= 1
+        if not self._size:
+            self._idle.set()
+        pending = self._chat_pending.get(chat_id)
+        if pending:
+            self._requeue(self._queue, pending.popleft())
+        else:
+            self._chat_pending.pop(chat_id, None)
+
+    # Загальний ліміт і пауза після RetryAfter стосуються всіх чатів, тож на них обробник може почекати
+    async def _wait_for_global(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                delay = self._global.take()
+                if delay <= 0:
+                    return
+            await asyncio.sleep(delay)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_size:
+                self._prune_chats()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    # Забути відра чатів, що давно нічого не отримували (їхнє відро вже повне)
+    def _prune_chats(self):
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items()
+                        if bucket.is_full() and chat_id not in self._chat_pending]:
+            del self._chats[chat_id]
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            _, _, chat_id, send, args, kwargs, future, is_next = item
+            if not is_next:
+                pending = self._chat_pending.get(chat_id)
+                if pending is not None:
+                    # Чат зайнятий попереднім повідомленням: стаємо в його чергу, щоб зберегти порядок
+                    pending.append(item)
+                    continue
+                self._chat_pending[chat_id] = collections.deque()
+            if future is not None and future.cancelled():
+                self._done(chat_id)
+                continue
+            delay = self._chat_bucket(chat_id).take()
+            if delay > 0:
+                # Ліміт чату вичерпано: повертаємо повідомлення в чергу через delay, а обробник бере інші чати
+                asyncio.get_running_loop().call_later(delay, self._requeue, self._queue, item)
+                continue
+            try:
+                result = await self._send(send, args, kwargs)
+                if future is not None and not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            finally:
+                self._done(chat_id)
+
+    async def _send(self, send, args, kwargs):
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await self._wait_for_global()
+            try:
+                with metrics.timer("telegram_send_seconds", method=getattr(send, "__name__", "send")):
+                    return await send(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                # Telegram просить зачекати: пригальмовуємо всю чергу
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                self._paused_until = max(self._paused_until, time.monotonic() + float(retry_after))
+
+
+outbox = Outbox()
+metrics.gauge("outbox_queue_size", "Кількість повідомлень у черзі відправлення", outbox.qsize)
@@ -0,0 +1,163 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from models import aggregate_daily, is_wet_code
+from weather_client import CURRENT_TTL, FORECAST_TTL
+
+# Скільки готових текстів повідомлень тримати в пам'яті
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 1024))
+
+# Групи погодних умов за кодом OpenWeatherMap (а не за текстом локалізованого опису)
+WET, CLOUDS, CLEAR, OTHER = range(4)
+
+
+def _condition_kind(code):
+    if is_wet_code(code):
+        return WET
+    if code == 800:
+        return CLEAR
+    if code // 100 == 8:
+        return CLOUDS
+    return OTHER
+
+
+# Таблиці, обчислені один раз: код погоди (0–999) -> група та емодзі
+CONDITION_KINDS = tuple(_condition_kind(code) for code in range(1000))
+KIND_EMOJI = {WET: "🌦️", CLOUDS: "☁️", CLEAR: "☀️", OTHER: "🌤️"}
+CONDITION_EMOJI = tuple(KIND_EMOJI[kind] for kind in CONDITION_KINDS)
+
+_cache = OrderedDict()
+
+
+def condition_kind(code):
+    return CONDITION_KINDS[code] if 0 <= code < 1000 else OTHER
+
+
+# Емодзі для погоди
+def get_weather_emoji(code):
+    return CONDITION_EMOJI[code] if 0 <= code < 1000 else KIND_EMOJI[OTHER]
+
+# Емодзі для температури
+def get_temp_emoji(temp):
+    if temp < 5:
+        return "❄️"
+    elif temp < 20:
+        return "😎"
+    return "🔥"
+
+# Емодзі для вітру
+def get_wind_emoji(wind):
+    if wind > 10:
+        return "🌪️"
+    elif wind > 5:
+        return "🌬️"
+    return "🍃"
+
+# Рекомендація одягу
+def get_weather_advice(code, temp, wind, humidity):
+    if condition_kind(code) == WET:
+        return "Візьміть парасолю та водонепроникний одяг ☂️"
+    elif temp < 5 or wind > 10:
+        return "Одягніть теплий одяг, шапку та рукавички 🧥🧤"
+    elif temp > 25 and humidity < 50:
+        return "Легкий одяг і сонцезахисний крем 😎🧴"
+    return "Одягайтеся зручно 👕"
+
+# Порада дня
+def get_daily_tip(code, temp, wind):
+    kind = condition_kind(code)
+    if kind == WET or wind > 10:
+        return "Залишайтеся вдома з книгою або фільмом 📚🎬"
+    elif temp > 20 and kind == CLEAR:
+        return "Ідеально для пікніка або прогулянки в парку! 🧺🌳"
+    elif temp < 5:
+        return "Час для гарячого чаю та теплої ковдри ☕🛋️"
+    return "Чудовий день для будь-яких планів! 😊"
+
+
+# Готовий результат з кешу або render(), збережений під key; однакове місто й спостереження
+# форматуються один раз для всіх отримувачів
+def _cached(key, render):
+    value = _cache.get(key)
+    if value is not None:
+        _cache.move_to_end(key)
+        return value
+    value = _cache[key] = render()
+    while len(_cache) > RENDER_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return value
+
+
+# Позначка віку даних, якщо API недоступний і показано застарілу відповідь з кешу
+def format_data_age(fetched_at, ttl):
+    age = time.time() - fetched_at
+    if not fetched_at or age <= ttl:
+        return ""
+    return f"\n\n🕒 Дані отримано {int(age // 60)} хв тому"
+
+# Форматування поточної погоди з уже завантажених даних (CurrentConditions);
+# текст кешується за (місто, час спостереження, мова), позначка віку додається щоразу
+def format_current_weather(city, conditions, lang="uk"):
+    if conditions is None:
+        return f"Не вдалося знайти погоду для {city}."
+    key = ("current", city, conditions.city_id, conditions.observed_at, lang)
+    text = _cached(key, lambda: _render_current_weather(city, conditions))
+    return text + format_data_age(conditions.fetched_at, CURRENT_TTL)
+
+
+def _render_current_weather(city, conditions):
+    temp = conditions.temp
+    temp_min = conditions.temp_min
+    temp_max = conditions.temp_max
+    humidity = conditions.humidity
+    wind = conditions.wind_speed
+    code = conditions.condition_code
+    uv_index = 0
+    uv_advice = "Недоступно"
+    return (f"📍 Погода в {city} 🌟:\n"
+            f"{get_weather_emoji(code)} • {conditions.description.title()}\n"
+            f"🌡️ • Температура: {temp:.2f}°C (мін: {temp_min:.2f}°C, макс: {temp_max:.2f}°C) {get_temp_emoji(temp)}\n"
+            f"💧 • Вологість: {humidity}% 💦\n"
+            f"💨 • Вітер: {wind} м/с {get_wind_emoji(wind)}\n"
+            f"☀️ • UV-індекс: {uv_index:.1f} ({uv_advice})\n\n"
+            f"{get_weather_advice(code, temp, wind, humidity)}\n{get_daily_tip(code, temp, wind)}")
+
+# Форматування прогнозу (Forecast): по днях із денними підсумками; графік — за всіма 3-годинними точками.
+# Повертає (текст, час точок, температури); результат кешується за (місто, час завантаження, мова)
+def format_forecast(city, forecast, lang="uk"):
+    key = ("forecast", city, forecast.city_id, forecast.fetched_at, lang)
+    text, times, temps = _cached(key, lambda: _render_forecast(city, forecast))
+    return text + format_data_age(forecast.fetched_at, FORECAST_TTL), times, temps
+
+
+def _render_forecast(city, forecast):
+    lines = []
+    rainy_days = 0
+    for day in aggregate_daily(forecast):
+        code = day.condition_code
+        if day.rainy:
+            rainy_days += 1
+        # Для неповного дня показуємо, за які години зібрано підсумок, щоб мін/макс не читались як добові
+        span = f" (лише {day.first_point:%H:%M}–{day.last_point:%H:%M})" if day.partial else ""
+        lines.append(
+            f"📍 {day.day:%Y-%m-%d} 🗓️{span}\n"
+            f"{get_weather_emoji(code)} • {day.description.title()}\n"
+            f"🌡️ • Температура: {day.temp_mean:.2f}°C (мін: {day.temp_min:.2f}°C, макс: {day.temp_max:.2f}°C) {get_temp_emoji(day.temp_mean)}\n"
+            f"💧 • Вологість: {day.humidity:.0f}% 💦\n"
+            f"☔ • Опади: {day.precipitation:.1f} мм\n"
+            f"💨 • Вітер: до {day.wind_max} м/с {get_wind_emoji(day.wind_max)}\n"
+            f"💡 • Порада: {get_daily_tip(code, day.temp_mean, day.wind_max)}\n"
+        )
+    conclusion = f"Висновок для {city}: "
+    if rainy_days > 0:
+        conclusion += (f"Теплий тиждень, але чекай на {rainy_days} дощових днів 🌧️. "
+                      f"Тримай парасольку напоготові! ☂️")
+    else:
+        conclusion += "Теплий і приємний тиждень! 🌞 Ідеально для прогулянок 🚶‍♀️ і активного відпочинку 🚴‍♀️."
+    text = f"📅 Прогноз погоди по днях у {city} 🌟:\n\n" + "\n".join(lines) + f"\n{conclusion}"
+    times = tuple(datetime.fromtimestamp(point.ts + forecast.timezone_offset, timezone.utc).replace(tzinfo=None)
+                  for point in forecast.points)
+    temps = tuple(point.temp for point in forecast.points)
+    return text, times, temps
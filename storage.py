@@ -0,0 +1,542 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from models import City
+
+# Шлях до бази даних SQLite
+DB_PATH = os.getenv("DB_PATH", "/app/data/weather_bot.db")
+
+# Пакетний запис журналу запитів
+REQUEST_LOG_BATCH = int(os.getenv("REQUEST_LOG_BATCH", 100))
+REQUEST_LOG_FLUSH_INTERVAL = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", 5))
+
+# Зберігання історії: скільки сирих записів лишати кожному користувачу і розмір порції ущільнення
+REQUEST_HISTORY_KEEP = int(os.getenv("REQUEST_HISTORY_KEEP", 20))
+COMPACT_CHUNK_SIZE = int(os.getenv("COMPACT_CHUNK_SIZE", 500))
+VACUUM_PAGES_PER_STEP = int(os.getenv("VACUUM_PAGES_PER_STEP", 200))
+
+# Скільки зберігати незавершений вибір міст користувача і застарілі записи спільного кешу погоди
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", 86400))
+WEATHER_CACHE_KEEP = int(os.getenv("WEATHER_CACHE_KEEP", 3 * 3600))
+
+# Усі звернення до бази виконуються в одному окремому потоці з одним довгоживучим з'єднанням
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_conn = None
+_pending_requests = deque()
+logger = logging.getLogger(__name__)
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Діє лише для нової бази; для наявної звільнені сторінки просто використовуються повторно
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    return conn
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = _connect()
+    return _conn
+
+
+# Декоратор: асинхронний виклик функції в потоці бази даних;
+# func.blocking(...) виконує те саме синхронно (для старту до запуску циклу подій).
+# Час виконання в потоці бази записується в метрику sqlite_query_seconds
+def db_task(func):
+    func = metrics.timed("sqlite_query_seconds", helper=func.__name__)(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args))
+
+    wrapper.blocking = lambda *args: _executor.submit(func, *args).result()
+    return wrapper
+
+
+# Міграція 1: початкова схема (так само створювалась до появи міграцій)
+def _migration_initial(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS requests
+                    (user_id INTEGER, city TEXT, request_type TEXT, timestamp TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS favorite_cities
+                    (user_id INTEGER, city TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS notifications
+                    (user_id INTEGER, notify_time TEXT, UNIQUE(user_id, notify_time))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS alerts
+                    (user_id INTEGER, enabled INTEGER, UNIQUE(user_id))''')
+
+
+# Міграція 2: первинні ключі, індекси, унікальні улюблені міста та час у секундах epoch
+def _migration_keys_and_indexes(conn):
+    conn.execute('''CREATE TABLE requests_new
+                    (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, city TEXT NOT NULL,
+                     request_type TEXT NOT NULL, ts INTEGER NOT NULL)''')
+    # Старі мітки часу записані як локальний час, 'utc' переводить їх в UTC
+    conn.execute('''INSERT INTO requests_new (user_id, city, request_type, ts)
+                    SELECT user_id, city, request_type, CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                    FROM requests WHERE timestamp IS NOT NULL ORDER BY timestamp''')
+    conn.execute("DROP TABLE requests")
+    conn.execute("ALTER TABLE requests_new RENAME TO requests")
+    conn.execute("CREATE INDEX idx_requests_user_ts ON requests (user_id, ts)")
+
+    conn.execute('''CREATE TABLE favorite_cities_new
+                    (user_id INTEGER NOT NULL, city TEXT NOT NULL,
+                     PRIMARY KEY (user_id, city)) WITHOUT ROWID''')
+    conn.execute('''INSERT OR IGNORE INTO favorite_cities_new (user_id, city)
+                    SELECT user_id, city FROM favorite_cities WHERE city IS NOT NULL''')
+    conn.execute("DROP TABLE favorite_cities")
+    conn.execute("ALTER TABLE favorite_cities_new RENAME TO favorite_cities")
+
+    conn.execute('''CREATE TABLE notifications_new
+                    (user_id INTEGER NOT NULL, notify_time TEXT NOT NULL,
+                     PRIMARY KEY (user_id, notify_time)) WITHOUT ROWID''')
+    conn.execute('''INSERT OR IGNORE INTO notifications_new (user_id, notify_time)
+                    SELECT user_id, notify_time FROM notifications WHERE notify_time IS NOT NULL''')
+    conn.execute("DROP TABLE notifications")
+    conn.execute("ALTER TABLE notifications_new RENAME TO notifications")
+    conn.execute("CREATE INDEX idx_notifications_time ON notifications (notify_time)")
+
+    conn.execute('''CREATE TABLE alerts_new
+                    (user_id INTEGER PRIMARY KEY, enabled INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute('''INSERT OR REPLACE INTO alerts_new (user_id, enabled)
+                    SELECT user_id, COALESCE(enabled, 0) FROM alerts WHERE user_id IS NOT NULL''')
+    conn.execute("DROP TABLE alerts")
+    conn.execute("ALTER TABLE alerts_new RENAME TO alerts")
+
+
+# Міграція 3: денні агрегати запитів для старої історії
+def _migration_request_rollup(conn):
+    conn.execute('''CREATE TABLE request_daily
+                    (day TEXT NOT NULL, city TEXT NOT NULL, request_type TEXT NOT NULL,
+                     count INTEGER NOT NULL, PRIMARY KEY (day, city, request_type)) WITHOUT ROWID''')
+
+
+# Міграція 4: індекс міст (ідентифікатори OpenWeatherMap і варіанти назв), улюблені міста за id
+def _migration_city_index(conn):
+    conn.execute('''CREATE TABLE cities
+                    (id INTEGER PRIMARY KEY, name TEXT NOT NULL, lat REAL, lon REAL)''')
+    conn.execute('''CREATE TABLE city_aliases
+                    (alias TEXT PRIMARY KEY, city_id INTEGER NOT NULL REFERENCES cities (id)) WITHOUT ROWID''')
+    # Старі записи отримують city_id під час фонового розпізнавання при старті
+    conn.execute("ALTER TABLE favorite_cities ADD COLUMN city_id INTEGER")
+    conn.execute('''CREATE UNIQUE INDEX idx_favorite_cities_user_city_id
+                    ON favorite_cities (user_id, city_id) WHERE city_id IS NOT NULL''')
+
+
+# Міграція 5: надіслані сповіщення про екстремальну погоду (щоб не повторювати їх, поки подія триває)
+def _migration_sent_alerts(conn):
+    conn.execute('''CREATE TABLE sent_alerts
+                    (user_id INTEGER NOT NULL, city_id INTEGER NOT NULL, event TEXT NOT NULL,
+                     sent_at INTEGER NOT NULL, PRIMARY KEY (user_id, city_id, event)) WITHOUT ROWID''')
+
+
+# Міграція 6: спільний стан для кількох процесів бота — вибір міст користувача,
+# оренда ролі лідера планувальника і спільний кеш відповідей OpenWeatherMap
+def _migration_shared_state(conn):
+    conn.execute('''CREATE TABLE user_state
+                    (user_id INTEGER PRIMARY KEY, cities TEXT NOT NULL, updated_at INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE leases
+                    (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE weather_cache
+                    (endpoint TEXT NOT NULL, city_id INTEGER NOT NULL, lang TEXT NOT NULL,
+                     fetched_at INTEGER NOT NULL, expires_at INTEGER NOT NULL, body BLOB NOT NULL,
+                     PRIMARY KEY (endpoint, city_id, lang))''')
+
+
+# Список міграцій; номер застосованої версії зберігається в PRAGMA user_version
+MIGRATIONS = [
+    _migration_initial,
+    _migration_keys_and_indexes,
+    _migration_request_rollup,
+    _migration_city_index,
+    _migration_sent_alerts,
+    _migration_shared_state,
+]
+
+
+# Ініціалізація бази даних SQLite: застосування нових міграцій на місці.
+# BEGIN IMMEDIATE і повторне читання версії: якщо кілька процесів стартують одночасно,
+# кожну міграцію застосовує лише один з них
+@db_task
+def init_db():
+    conn = _get_conn()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# Закриття з'єднання із записом буфера журналу
+@db_task
+def close_db():
+    global _conn
+    if _conn is not None:
+        _flush_requests()
+        _conn.close()
+        _conn = None
+
+
+# Збереження запиту: лише додається в буфер, запис у базу відбувається пакетами
+def save_request(user_id, city, request_type):
+    _pending_requests.append((user_id, city, request_type, int(time.time())))
+    if len(_pending_requests) >= REQUEST_LOG_BATCH:
+        _executor.submit(_flush_requests)
+
+
+def _flush_requests():
+    rows = []
+    while _pending_requests:
+        rows.append(_pending_requests.popleft())
+    if not rows:
+        return
+    try:
+        conn = _get_conn()
+        with conn:
+            conn.executemany("INSERT INTO requests (user_id, city, request_type, ts) VALUES (?, ?, ?, ?)",
+                             rows)
+    except sqlite3.Error:
+        # Запис не вдався (наприклад, база зайнята іншим процесом): повертаємо пакет на початок буфера
+        _pending_requests.extendleft(reversed(rows))
+        raise
+
+
+flush_requests = db_task(_flush_requests)
+
+
+# Періодичний запис буфера журналу запитів; помилка бази не зупиняє цикл — записи лишаються в буфері до наступної спроби
+async def flush_requests_periodically(interval=REQUEST_LOG_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_requests()
+        except sqlite3.Error:
+            logger.exception("Не вдалося записати журнал запитів (%d у буфері)", len(_pending_requests))
+
+
+# Збереження улюбленого міста (City)
+@db_task
+def save_favorite_city(user_id, city):
+    conn = _get_conn()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO favorite_cities (user_id, city, city_id) VALUES (?, ?, ?)",
+                     (user_id, city.name, city.id))
+
+
+# Отримання улюблених міст (список City)
+@db_task
+def get_favorite_cities(user_id):
+    rows = _get_conn().execute("SELECT f.city_id, f.city, c.lat, c.lon FROM favorite_cities f "
+                               "LEFT JOIN cities c ON c.id = f.city_id WHERE f.user_id = ?", (user_id,))
+    return [City(*row) for row in rows]
+
+
+# Назви старих улюблених міст, для яких ще немає ідентифікатора
+@db_task
+def get_unresolved_favorite_names():
+    rows = _get_conn().execute("SELECT DISTINCT city FROM favorite_cities WHERE city_id IS NULL")
+    return [row[0] for row in rows]
+
+
+# Прив'язка старих улюблених міст до розпізнаного міста; дублікати (те саме місто під
+# іншою назвою) видаляються
+@db_task
+def resolve_favorite_city(name, city):
+    conn = _get_conn()
+    with conn:
+        conn.execute("UPDATE OR IGNORE favorite_cities SET city = ?, city_id = ? WHERE city = ? AND city_id IS NULL",
+                     (city.name, city.id, name))
+        conn.execute("DELETE FROM favorite_cities WHERE city = ? AND city_id IS NULL", (name,))
+
+
+# Індекс міст: усі відомі міста і варіанти їхніх назв
+@db_task
+def load_city_index():
+    conn = _get_conn()
+    cities = [City(*row) for row in conn.execute("SELECT id, name, lat, lon FROM cities")]
+    aliases = conn.execute("SELECT alias, city_id FROM city_aliases").fetchall()
+    return cities, aliases
+
+
+# Збереження міста та варіантів його назви
+@db_task
+def save_city(city, aliases):
+    conn = _get_conn()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO cities (id, name, lat, lon) VALUES (?, ?, ?, ?)",
+                     (city.id, city.name, city.lat, city.lon))
+        conn.executemany("INSERT OR REPLACE INTO city_aliases (alias, city_id) VALUES (?, ?)",
+                         [(alias, city.id) for alias in aliases])
+
+
+# Місто за нормалізованою назвою з індексу в базі (його міг додати інший процес бота)
+@db_task
+def find_city_by_alias(alias):
+    row = _get_conn().execute("SELECT c.id, c.name, c.lat, c.lon FROM city_aliases a "
+                              "JOIN cities c ON c.id = a.city_id WHERE a.alias = ?", (alias,)).fetchone()
+    return City(*row) if row else None
+
+
+# Міста, введені користувачем, до натискання кнопки типу прогнозу (спільні для всіх процесів бота)
+@db_task
+def set_pending_cities(user_id, cities):
+    conn = _get_conn()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO user_state (user_id, cities, updated_at) VALUES (?, ?, ?)",
+                     (user_id, json.dumps(cities, ensure_ascii=False), int(time.time())))
+
+
+# Забрати вибір міст: читання й видалення в одній транзакції, тож два одночасні натискання кнопки
+# (або два процеси бота) не обробляють той самий вибір двічі
+@db_task
+def take_pending_cities(user_id):
+    conn = _get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT cities FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return json.loads(row[0]) if row else None
+
+
+@db_task
+def clear_pending_cities(user_id):
+    conn = _get_conn()
+    with conn:
+        conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+
+# Оренда ролі (наприклад, лідера планувальника): True, якщо holder тримає її ще ttl секунд.
+# Чужу оренду можна перехопити лише після її закінчення
+@db_task
+def acquire_lease(name, holder, ttl):
+    conn = _get_conn()
+    now = time.time()
+    with conn:
+        conn.execute("INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                     "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                     "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                     (name, holder, now + ttl, now))
+        current = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()[0]
+    return current == holder
+
+
+@db_task
+def release_lease(name, holder):
+    conn = _get_conn()
+    with conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+# Спільний кеш відповідей OpenWeatherMap: (fetched_at, expires_at, body) свіжого запису або None
+@db_task
+def get_cached_weather(endpoint, city_id, lang):
+    return _get_conn().execute("SELECT fetched_at, expires_at, body FROM weather_cache "
+                               "WHERE endpoint = ? AND city_id = ? AND lang = ? AND expires_at > ?",
+                               (endpoint, city_id, lang, int(time.time()))).fetchone()
+
+
+@db_task
+def save_cached_weather(endpoint, city_id, lang, fetched_at, expires_at, body):
+    conn = _get_conn()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO weather_cache (endpoint, city_id, lang, fetched_at, expires_at, body) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (endpoint, city_id, lang, fetched_at, expires_at, body))
+
+
+# Видалення застарілого спільного стану: давно не оновлений вибір міст і прострочений кеш погоди
+@db_task
+def prune_shared_state():
+    conn = _get_conn()
+    now = int(time.time())
+    with conn:
+        conn.execute("DELETE FROM user_state WHERE updated_at < ?", (now - USER_STATE_TTL,))
+        conn.execute("DELETE FROM weather_cache WHERE expires_at < ?", (now - WEATHER_CACHE_KEEP,))
+
+
+# Збереження часу оповіщень
+@db_task
+def save_notification_time(user_id, notify_time):
+    conn = _get_conn()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO notifications (user_id, notify_time) VALUES (?, ?)",
+                     (user_id, notify_time))
+
+
+# Отримання часу оповіщень
+@db_task
+def get_notification_times(user_id):
+    rows = _get_conn().execute("SELECT notify_time FROM notifications WHERE user_id = ?", (user_id,))
+    return [row[0] for row in rows]
+
+
+# Видалення оповіщень
+@db_task
+def delete_notifications(user_id):
+    conn = _get_conn()
+    with conn:
+        conn.execute("DELETE FROM notifications WHERE user_id = ?", (user_id,))
+
+
+# Збереження налаштувань сповіщень про екстремальну погоду
+@db_task
+def save_alert_setting(user_id, enabled):
+    conn = _get_conn()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO alerts (user_id, enabled) VALUES (?, ?)", (user_id, enabled))
+
+
+# Улюблені міста всіх користувачів з увімкненими сповіщеннями: user_id -> список City (один запит)
+@db_task
+def get_alert_subscriptions():
+    rows = _get_conn().execute("SELECT a.user_id, f.city_id, f.city, c.lat, c.lon FROM alerts a "
+                               "JOIN favorite_cities f ON f.user_id = a.user_id "
+                               "LEFT JOIN cities c ON c.id = f.city_id "
+                               "WHERE a.enabled = 1 AND f.city_id IS NOT NULL")
+    subscriptions = {}
+    for user_id, city_id, name, lat, lon in rows:
+        subscriptions.setdefault(user_id, []).append(City(city_id, name, lat, lon))
+    return subscriptions
+
+
+# Відбір нових сповіщень: active — усі поточні (user_id, city_id, event) для перевірених міст.
+# Повертає ті, що ще не надсилались; події, що скінчились, забуваються
+@db_task
+def claim_alerts(active, checked_city_ids):
+    conn = _get_conn()
+    with conn:
+        sent = set(conn.execute("SELECT user_id, city_id, event FROM sent_alerts"))
+        active = set(active)
+        new = active - sent
+        finished = [row for row in sent - active if row[1] in checked_city_ids]
+        now = int(time.time())
+        conn.executemany("INSERT INTO sent_alerts (user_id, city_id, event, sent_at) VALUES (?, ?, ?, ?)",
+                         [(*row, now) for row in new])
+        conn.executemany("DELETE FROM sent_alerts WHERE user_id = ? AND city_id = ? AND event = ?", finished)
+    return new
+
+
+# Підписники слоту оповіщень разом з їхніми улюбленими містами (один запит)
+@db_task
+def get_slot_subscribers(notify_time):
+    rows = _get_conn().execute("SELECT n.user_id, f.city_id, f.city, c.lat, c.lon FROM notifications n "
+                               "LEFT JOIN favorite_cities f ON f.user_id = n.user_id "
+                               "LEFT JOIN cities c ON c.id = f.city_id "
+                               "WHERE n.notify_time = ?", (notify_time,))
+    subscribers = {}
+    for user_id, city_id, name, lat, lon in rows:
+        cities = subscribers.setdefault(user_id, [])
+        if name is not None:
+            cities.append(City(city_id, name, lat, lon))
+    return subscribers
+
+
+# Міста підписників найближчих слотів оповіщень (для попереднього завантаження погоди)
+@db_task
+def get_slot_city_ids(notify_times):
+    placeholders = ",".join("?" * len(notify_times))
+    rows = _get_conn().execute(f"SELECT DISTINCT f.city_id FROM notifications n "
+                               f"JOIN favorite_cities f ON f.user_id = n.user_id "
+                               f"WHERE n.notify_time IN ({placeholders}) AND f.city_id IS NOT NULL",
+                               list(notify_times))
+    return [row[0] for row in rows]
+
+
+# Найпопулярніші улюблені міста (ідентифікатори, від найчастішого)
+@db_task
+def get_popular_city_ids(limit):
+    rows = _get_conn().execute("SELECT city_id FROM favorite_cities WHERE city_id IS NOT NULL "
+                               "GROUP BY city_id ORDER BY COUNT(*) DESC LIMIT ?", (limit,))
+    return [row[0] for row in rows]
+
+
+# Отримання історії запитів (спершу записуємо буфер, щоб історія була актуальною)
+@db_task
+def get_history(user_id, limit=5):
+    _flush_requests()
+    rows = _get_conn().execute("SELECT city, request_type, "
+                               "strftime('%Y-%m-%d %H:%M:%S', ts, 'unixepoch', 'localtime') FROM requests "
+                               "WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT ?", (user_id, limit))
+    return rows.fetchall()
+
+
+# Користувачі, у яких сирих записів історії більше, ніж потрібно зберігати
+@db_task
+def get_users_over_history_limit(keep):
+    rows = _get_conn().execute("SELECT user_id FROM requests GROUP BY user_id HAVING COUNT(*) > ?", (keep,))
+    return [row[0] for row in rows]
+
+
+# Одна порція ущільнення: найстаріші записи понад ліміт згортаються в денні агрегати і видаляються
+@db_task
+def compact_user_requests(user_id, keep, chunk):
+    conn = _get_conn()
+    with conn:
+        ids = [row[0] for row in conn.execute("SELECT id FROM requests WHERE user_id = ? "
+                                              "ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+                                              (user_id, chunk, keep))]
+        if not ids:
+            return 0
+        placeholders = ",".join("?" * len(ids))
+        conn.execute(f"""INSERT INTO request_daily (day, city, request_type, count)
+                         SELECT date(ts, 'unixepoch', 'localtime'), city, request_type, COUNT(*)
+                         FROM requests WHERE id IN ({placeholders})
+                         GROUP BY 1, 2, 3
+                         ON CONFLICT (day, city, request_type) DO UPDATE SET count = count + excluded.count""",
+                     ids)
+        conn.execute(f"DELETE FROM requests WHERE id IN ({placeholders})", ids)
+    return len(ids)
+
+
+# Поступове звільнення сторінок (лише для бази з auto_vacuum=INCREMENTAL)
+@db_task
+def incremental_vacuum(pages):
+    conn = _get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # executescript проганяє прагму до кінця (execute звільняє лише одну сторінку за крок)
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return free_pages
+
+
+# Фонове ущільнення історії запитів короткими транзакціями, щоб не тримати довге блокування запису
+async def compact_requests(keep=REQUEST_HISTORY_KEEP, chunk=COMPACT_CHUNK_SIZE):
+    await flush_requests()
+    removed = 0
+    for user_id in await get_users_over_history_limit(keep):
+        while True:
+            count = await compact_user_requests(user_id, keep, chunk)
+            removed += count
+            if count < chunk:
+                break
+    await prune_shared_state()
+    while await incremental_vacuum(VACUUM_PAGES_PER_STEP) > VACUUM_PAGES_PER_STEP:
+        pass
+    return removed
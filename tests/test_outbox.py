@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+from outbox import Outbox
+
+
+def test_busy_chat_does_not_hold_up_other_chats():
+    async def scenario():
+        box = Outbox(global_rate=1000, chat_rate=2, chat_burst=1, workers=2)
+        sent = []
+        started = time.monotonic()
+
+        async def send(chat_id, n):
+            sent.append((chat_id, n, time.monotonic() - started))
+
+        # Два чати з довгою чергою, більше ніж обробників
+        for chat_id in (1, 2):
+            for n in range(4):
+                await box.post(chat_id, send, chat_id, n)
+        for chat_id in range(10, 20):
+            await box.post(chat_id, send, chat_id, 0)
+        await box.submit(99, send, 99, 0)
+        await box.close(timeout=5)
+
+        assert [n for chat_id, n, _ in sent if chat_id == 1] == [0, 1, 2, 3]
+        assert [n for chat_id, n, _ in sent if chat_id == 2] == [0, 1, 2, 3]
+        assert max(at for chat_id, _, at in sent if chat_id >= 10) < 0.2
+        assert box.qsize() == 0
+
+    asyncio.run(scenario())
+
+
+def test_submit_returns_result_and_error():
+    async def scenario():
+        box = Outbox(global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+
+        async def ok():
+            return "sent"
+
+        async def fail():
+            raise ValueError("bad request")
+
+        assert await box.submit(1, ok) == "sent"
+        try:
+            await box.submit(1, fail)
+        except ValueError as e:
+            assert str(e) == "bad request"
+        else:
+            raise AssertionError("error was not propagated")
+        await box.close()
+
+    asyncio.run(scenario())
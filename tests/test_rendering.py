@@ -0,0 +1,40 @@
+from models import Forecast, ForecastPoint, aggregate_daily
+from rendering import WET, condition_kind, format_forecast
+
+DAY = 1700006400  # 2023-11-15 00:00 UTC
+
+
+def forecast_with(code, description):
+    points = tuple(ForecastPoint(DAY + hour * 3600, 3.0, 2.0, 4.0, 80, 4.0, 0.5, code, description)
+                   for hour in range(0, 24, 3))
+    return Forecast(1, "Київ", 0, points, 1700000000 + code)
+
+
+def test_sleet_day_is_rainy_and_gets_umbrella_advice():
+    forecast = forecast_with(612, "дощ зі снігом")
+    assert condition_kind(612) == WET
+    assert aggregate_daily(forecast)[0].rainy
+    text, _, _ = format_forecast("Київ", forecast)
+    assert "Тримай парасольку" in text
+
+
+def test_snow_day_is_not_rainy():
+    forecast = forecast_with(601, "сніг")
+    assert condition_kind(601) != WET
+    assert not aggregate_daily(forecast)[0].rainy
+    text, _, _ = format_forecast("Київ", forecast)
+    assert "Теплий і приємний тиждень" in text
+
+
+def test_partial_days_are_marked():
+    start = DAY + 15 * 3600
+    points = tuple(ForecastPoint(start + step * 3 * 3600, 10.0, 9.0, 11.0, 60, 3.0, 0.0, 800, "ясно")
+                   for step in range(40))
+    forecast = Forecast(1, "Київ", 7200, points, 1700000001)
+    days = aggregate_daily(forecast)
+    assert len(days) == 6
+    assert [day.partial for day in days] == [True, False, False, False, False, True]
+    assert f"{days[0].first_point:%H:%M}" == "17:00"
+    text, _, _ = format_forecast("Київ", forecast)
+    assert "5 днів" not in text
+    assert "(лише 17:00–23:00)" in text
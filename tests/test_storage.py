@@ -0,0 +1,64 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(storage, "_conn", None)
+    storage._pending_requests.clear()
+    storage.init_db.blocking()
+    yield tmp_path / "bot.db"
+    storage.close_db.blocking()
+
+
+def test_failed_flush_keeps_rows_in_buffer(db):
+    storage._get_conn().execute("PRAGMA busy_timeout=0")
+    other = sqlite3.connect(db)
+    other.execute("BEGIN EXCLUSIVE")
+    storage.save_request(1, "Київ", "current")
+    storage.save_request(1, "Львів", "forecast")
+    with pytest.raises(sqlite3.OperationalError):
+        storage.flush_requests.blocking()
+    assert [row[1] for row in storage._pending_requests] == ["Київ", "Львів"]
+
+    other.rollback()
+    other.close()
+    history = storage.get_history.blocking(1)
+    assert sorted(row[0] for row in history) == ["Київ", "Львів"]
+    assert not storage._pending_requests
+
+
+def test_periodic_flush_survives_database_errors(monkeypatch):
+    calls = []
+
+    async def flaky_flush():
+        calls.append(True)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(storage, "flush_requests", flaky_flush)
+
+    async def wait_for_calls(task):
+        while len(calls) < 3 and not task.done():
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        task = asyncio.ensure_future(storage.flush_requests_periodically(interval=0.01))
+        await asyncio.wait_for(wait_for_calls(task), 2)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_pending_cities_are_taken_once(db):
+    async def scenario():
+        await storage.set_pending_cities(1, ["Київ", "Львів"])
+        return await asyncio.gather(storage.take_pending_cities(1), storage.take_pending_cities(1))
+
+    assert sorted(asyncio.run(scenario()), key=bool) == [None, ["Київ", "Львів"]]
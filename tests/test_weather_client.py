@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import weather_client
+from weather_client import QuotaBudget, TTLCache, WeatherClient, WeatherUnavailable
+
+
+def current_payload(city_id):
+    return {"id": city_id, "name": "Київ", "coord": {"lat": 50.45, "lon": 30.52}, "dt": 1700000000,
+            "timezone": 7200, "main": {"temp": 12, "temp_min": 10, "temp_max": 14, "humidity": 50},
+            "wind": {"speed": 3}, "weather": [{"id": 800, "description": "ясно"}]}
+
+
+def make_client(handler, budget=None):
+    return WeatherClient(transport=httpx.MockTransport(handler), cache=TTLCache(),
+                         budget=budget or QuotaBudget(per_minute=1000, per_day=1000))
+
+
+def open_breaker(client, endpoint="current"):
+    breaker = client.breakers[endpoint]
+    breaker.state = "open"
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout - 1
+    return breaker
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(weather_client, "RETRY_BACKOFF", 0.001)
+
+
+def test_breaker_opens_after_repeated_failures():
+    async def scenario():
+        client = make_client(lambda request: httpx.Response(503))
+        for city_id in range(2):
+            with pytest.raises(weather_client.WeatherClientError):
+                await client.current(city_id)
+        assert client.breakers["current"].state == "open"
+        with pytest.raises(WeatherUnavailable):
+            await client.current(99)
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_probe_blocked_by_budget_does_not_wedge_breaker():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json=current_payload(int(request.url.params["id"])))
+
+    async def scenario():
+        budget = QuotaBudget(per_minute=0, per_day=1000)
+        client = make_client(handler, budget)
+        breaker = open_breaker(client)
+        with pytest.raises(WeatherUnavailable, match="budget"):
+            await client.current(1)
+        assert breaker.state == "open"
+        assert not calls
+
+        # Квота відновилась, час очікування минув: пробний запит проходить і замикає запобіжник
+        budget.per_minute = 1000
+        breaker.opened_at -= breaker.reset_timeout + 1
+        assert (await client.current(1)).city_id == 1
+        assert breaker.state == "closed"
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_does_not_wedge_breaker():
+    async def scenario():
+        started = asyncio.Event()
+        gate = asyncio.Event()
+
+        async def handler(request):
+            started.set()
+            await gate.wait()
+            return httpx.Response(200, json=current_payload(1))
+
+        client = make_client(handler)
+        breaker = open_breaker(client)
+        task = asyncio.ensure_future(client._request("current", weather_client.WEATHER_URL, {"id": 1}, True))
+        await started.wait()
+        assert breaker.state == "half_open"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert breaker.state == "open"
+
+        breaker.opened_at -= breaker.reset_timeout + 1
+        gate.set()
+        assert (await client.current(1)).city_id == 1
+        assert breaker.state == "closed"
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_stale_value_served_while_upstream_fails():
+    failing = []
+
+    def handler(request):
+        if failing:
+            return httpx.Response(503)
+        return httpx.Response(200, json=current_payload(1))
+
+    async def scenario():
+        client = make_client(handler)
+        first = await client.current(1)
+        key = ("current", 1, "uk")
+        entry = client.cache._entries[key]
+        client.cache._entries[key] = (time.monotonic() - 1,) + entry[1:]
+        failing.append(True)
+        assert await client.current(1) is first
+        await client.close()
+
+    asyncio.run(scenario())
@@ -1,282 +1,227 @@
 import telegram
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-import requests
-import sqlite3
-from datetime import datetime, time
+import asyncio
 import os
-from apscheduler.schedulers.background import BackgroundScheduler
+import socket
+import sqlite3
+import time
+import numpy as np
+from datetime import datetime, timedelta
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-import matplotlib.pyplot as plt
-import io
-import base64
-
-# Налаштування планувальника
-scheduler = BackgroundScheduler()
-scheduler.start()
-
-# Налаштування OpenWeatherMap API
-API_KEY = os.getenv("OPENWEATHER_API_KEY", "your_openweather_api_key")
-WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
-FORECAST_URL = "http://api.openweathermap.org/data/2.5/forecast"
-
-# Ініціалізація бази даних SQLite
-def init_db():
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS requests
-                 (user_id INTEGER, city TEXT, request_type TEXT, timestamp TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS favorite_cities
-                 (user_id INTEGER, city TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS notifications
-                 (user_id INTEGER, notify_time TEXT, UNIQUE(user_id, notify_time))''')
-    c.execute('''CREATE TABLE IF NOT EXISTS alerts
-                 (user_id INTEGER, enabled INTEGER, UNIQUE(user_id))''')
-    conn.commit()
-    conn.close()
-
-# Збереження запиту
-def save_request(user_id, city, request_type):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("INSERT INTO requests (user_id, city, request_type, timestamp) VALUES (?, ?, ?, ?)",
-              (user_id, city, request_type, timestamp))
-    conn.commit()
-    conn.close()
-
-# Збереження улюбленого міста
-def save_favorite_city(user_id, city):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO favorite_cities (user_id, city) VALUES (?, ?)", (user_id, city))
-    conn.commit()
-    conn.close()
-
-# Отримання улюблених міст
-def get_favorite_cities(user_id):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT city FROM favorite_cities WHERE user_id = ?", (user_id,))
-    cities = [row[0] for row in c.fetchall()]
-    conn.close()
-    return cities
-
-# Збереження часу оповіщень
-def save_notification_time(user_id, notify_time):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO notifications (user_id, notify_time) VALUES (?, ?)",
-              (user_id, notify_time))
-    conn.commit()
-    conn.close()
-
-# Отримання часу оповіщень
-def get_notification_times(user_id):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT notify_time FROM notifications WHERE user_id = ?", (user_id,))
-    times = [row[0] for row in c.fetchall()]
-    conn.close()
-    return times
-
-# Видалення оповіщень
-def delete_notifications(user_id):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("DELETE FROM notifications WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-
-# Збереження налаштувань сповіщень про екстремальну погоду
-def save_alert_setting(user_id, enabled):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO alerts (user_id, enabled) VALUES (?, ?)", (user_id, enabled))
-    conn.commit()
-    conn.close()
-
-# Отримання історії запитів
-def get_history(user_id, limit=5):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT city, request_type, timestamp FROM requests WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-              (user_id, limit))
-    history = c.fetchall()
-    conn.close()
-    return history
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from weather_client import weather_client, WeatherClientError, WeatherUnavailable
+from charts import get_temperature_chart
+from models import City
+from rendering import format_current_weather, format_forecast, get_temp_emoji
+from cities import city_index
+from outbox import outbox, PRIORITY_INTERACTIVE
+import metrics
+import storage
+
+# Час запуску процесу (для вимірювання тривалості старту)
+STARTED_AT = time.perf_counter()
+
+# Планувальник працює на циклі подій бота (запускається в on_startup), тож завдання використовують
+# ті самі HTTP-клієнти, кеші й чергу відправлення, що й обробники; одночасно виконується
+# не більше SCHEDULER_MAX_JOBS завдань
+scheduler = AsyncIOScheduler(job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 30})
+SCHEDULER_MAX_JOBS = int(os.getenv("SCHEDULER_MAX_JOBS", 2))
+job_semaphore = None
+request_log_task = None
+
+# Скільки оновлень Telegram обробляти одночасно (за замовчуванням PTB обробляє їх по одному)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+
+# Кілька процесів бота за балансувальником: заплановані завдання виконує лише лідер,
+# який тримає оренду в спільній базі й продовжує її кожну третину LEADER_LEASE_TTL
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 30))
+leader_until = 0.0
+leader_task = None
+
+# Пороги сповіщень про екстремальну погоду (коди погоди OpenWeatherMap)
+EXTREME_HEAT = 30
+EXTREME_FROST = -10
+# Сильний дощ: сильний, дуже сильний і екстремальний дощ та сильна злива
+HEAVY_RAIN_CODES = (502, 503, 504, 522)
+# Шторм: сильна й рвана гроза, шквал і торнадо (слабка чи звичайна гроза — не екстремальна погода)
+STORM_CODES = (202, 212, 221, 771, 781)
+
+# Попереднє завантаження погоди: міста слоту, що настане через WARM_AHEAD_MINUTES хвилин, і
+# WARM_POPULAR_CITIES найпопулярніших улюблених міст; не більше WARM_MAX_CALLS завантажень за запуск
+WARM_AHEAD_MINUTES = int(os.getenv("WARM_AHEAD_MINUTES", 5))
+WARM_POPULAR_CITIES = int(os.getenv("WARM_POPULAR_CITIES", 20))
+WARM_MAX_CALLS = int(os.getenv("WARM_MAX_CALLS", 30))
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", 5))
+
+# Найбільше фото в одному альбомі Telegram
+CHART_ALBUM_SIZE = 10
+
+# Найбільша кількість міст у /compare (щоб відповідь вмістилась в одне повідомлення)
+COMPARE_MAX_CITIES = 5
+
+# Місто за введеною назвою; якщо його не знайдено — City без id, погода для нього не завантажується
+async def resolve_city(name):
+    return await city_index.resolve(name) or City(None, name.strip().title(), None, None)
+
+# Завантаження поточної погоди (None, якщо місто не знайдено або API недоступний);
+# interactive=False — для розсилок і перевірок, що не повинні витрачати квоту відповідей користувачам
+async def fetch_current_weather(city, interactive=True):
+    if city.id is None:
+        return None
+    try:
+        return await weather_client.current(city.id, interactive=interactive)
+    except WeatherClientError:
+        return None
 
 # Отримання поточної погоди
-def get_current_weather(city):
-    try:
-        params = {"q": city, "appid": API_KEY, "units": "metric", "lang": "uk"}
-        response = requests.get(WEATHER_URL, params=params)
-        response.raise_for_status()
-        data = response.json()
-        temp = data["main"]["temp"]
-        temp_min = data["main"]["temp_min"]
-        temp_max = data["main"]["temp_max"]
-        humidity = data["main"]["humidity"]
-        wind = data["wind"]["speed"]
-        description = data["weather"][0]["description"]
-        weather_emoji = get_weather_emoji(description)
-        advice = get_weather_advice(description, temp, wind, humidity)
-        tip = get_daily_tip(description, temp, wind)
-        uv_index = 0
-        uv_advice = "Недоступно"
-        return (f"📍 Погода в {city} 🌟:\n"
-                f"{weather_emoji} • {description.title()}\n"
-                f"🌡️ • Температура: {temp:.2f}°C (мін: {temp_min:.2f}°C, макс: {temp_max:.2f}°C) {get_temp_emoji(temp)}\n"
-                f"💧 • Вологість: {humidity}% 💦\n"
-                f"💨 • Вітер: {wind} м/с {get_wind_emoji(wind)}\n"
-                f"☀️ • UV-індекс: {uv_index:.1f} ({uv_advice})\n\n"
-                f"{advice}\n{tip}")
-    except requests.RequestException:
-        return f"Не вдалося знайти погоду для {city}."
+async def get_current_weather(city, interactive=True):
+    return format_current_weather(city.name, await fetch_current_weather(city, interactive))
 
 # Отримання прогнозу на 5 днів
-def get_forecast(city):
+async def get_forecast(city):
     try:
-        params = {"q": city, "appid": API_KEY, "units": "metric", "lang": "uk"}
-        response = requests.get(FORECAST_URL, params=params)
-        response.raise_for_status()
-        data = response.json()
-        forecast = []
-        temps = []
-        dates = []
-        rainy_days = 0
-        for item in data["list"][::8]:
-            date = item["dt_txt"].split()[0]
-            temp = item["main"]["temp"]
-            temp_min = item["main"]["temp_min"]
-            temp_max = item["main"]["temp_max"]
-            humidity = item["main"]["humidity"]
-            wind = item["wind"]["speed"]
-            description = item["weather"][0]["description"]
-            weather_emoji = get_weather_emoji(description)
-            tip = get_daily_tip(description, temp, wind)
-            if "дощ" in description.lower():
-                rainy_days += 1
-            forecast.append(
-                f"📍 {date} 🗓️\n"
-                f"{weather_emoji} • {description.title()}\n"
-                f"🌡️ • Температура: {temp:.2f}°C (мін: {temp_min:.2f}°C, макс: {temp_max:.2f}°C) {get_temp_emoji(temp)}\n"
-                f"💧 • Вологість: {humidity}% 💦\n"
-                f"💨 • Вітер: {wind} м/с {get_wind_emoji(wind)}\n"
-                f"💡 • Порада: {tip}\n"
-            )
-            temps.append(temp)
-            dates.append(date[-5:])
-        conclusion = f"Висновок для {city}: "
-        if rainy_days > 0:
-            conclusion += (f"Теплий тиждень, але чекай на {rainy_days} дощових днів 🌧️. "
-                          f"Тримай парасольку напоготові! ☂️")
-        else:
-            conclusion += "Теплий і приємний тиждень! 🌞 Ідеально для прогулянок 🚶‍♀️ і активного відпочинку 🚴‍♀️."
-        chart = get_temperature_chart(dates, temps, city)
-        return (f"📅 Прогноз погоди на 5 днів у {city} 🌟:\n\n" + "\n".join(forecast) + f"\n{conclusion}", chart)
-    except requests.RequestException:
-        return (f"Не вдалося знайти прогноз для {city}.", None)
-
-# Емодзі для погоди
-def get_weather_emoji(description):
-    description = description.lower()
-    if "дощ" in description:
-        return "🌦️"
-    elif "хмар" in description:
-        return "☁️"
-    elif "ясно" in description or "чисте" in description:
-        return "☀️"
-    return "🌤️"
-
-# Емодзі для температури
-def get_temp_emoji(temp):
-    if temp < 5:
-        return "❄️"
-    elif temp < 20:
-        return "😎"
-    return "🔥"
-
-# Емодзі для вітру
-def get_wind_emoji(wind):
-    if wind > 10:
-        return "🌪️"
-    elif wind > 5:
-        return "🌬️"
-    return "🍃"
-
-# Рекомендація одягу
-def get_weather_advice(description, temp, wind, humidity):
-    description = description.lower()
-    if "дощ" in description:
-        return "Візьміть парасолю та водонепроникний одяг ☂️"
-    elif temp < 5 or wind > 10:
-        return "Одягніть теплий одяг, шапку та рукавички 🧥🧤"
-    elif temp > 25 and humidity < 50:
-        return "Легкий одяг і сонцезахисний крем 😎🧴"
-    return "Одягайтеся зручно 👕"
-
-# Порада дня
-def get_daily_tip(description, temp, wind):
-    description = description.lower()
-    if "дощ" in description or wind > 10:
-        return "Залишайтеся вдома з книгою або фільмом 📚🎬"
-    elif temp > 20 and "ясно" in description:
-        return "Ідеально для пікніка або прогулянки в парку! 🧺🌳"
-    elif temp < 5:
-        return "Час для гарячого чаю та теплої ковдри ☕🛋️"
-    return "Чудовий день для будь-яких планів! 😊"
-
-# Графік температури
-def get_temperature_chart(dates, temps, city):
-    plt.figure(figsize=(8, 4))
-    plt.plot(dates, temps, marker='o', color='#3498db', label=f'Температура в {city} (°C)')
-    plt.fill_between(dates, temps, color='rgba(52, 152, 219, 0.2)')
-    plt.title(f'Прогноз температури в {city}')
-    plt.xlabel('Дата')
-    plt.ylabel('Температура (°C)')
-    plt.legend()
-    plt.grid(True)
-    
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
-    
-    img_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-    return img_base64
-
-# Налаштування оповіщень
-async def send_notification(context: ContextTypes.DEFAULT_TYPE, user_id, bot):
-    cities = get_favorite_cities(user_id)
-    if not cities:
-        await bot.send_message(user_id, "Додайте улюблені міста через 'додати <місто>'.")
-        return
-    for city in cities:
-        weather = get_current_weather(city)
-        await bot.send_message(user_id, weather)
-
-# Перевірка екстремальної погоди
-async def check_extreme_weather(context: ContextTypes.DEFAULT_TYPE, user_id, bot):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT enabled FROM alerts WHERE user_id = ?", (user_id,))
-    enabled = c.fetchone()
-    if not enabled or not enabled[0]:
+        forecast = await weather_client.forecast(city.id) if city.id is not None else None
+    except WeatherClientError:
+        forecast = None
+    if forecast is None or not forecast.points:
+        return (f"Не вдалося знайти прогноз для {city.name}.", None)
+    text, times, temps = format_forecast(city.name, forecast)
+    chart = await get_temperature_chart(times, temps, city.name, forecast.points[0].ts)
+    return (text, chart)
+
+# Розсилка оповіщень для одного слоту: кожне місто завантажується і форматується один раз
+async def send_notification(bot, notify_time):
+    subscribers = await storage.get_slot_subscribers(notify_time)
+    if not subscribers:
         return
-    cities = get_favorite_cities(user_id)
-    for city in cities:
-        params = {"q": city, "appid": API_KEY, "units": "metric", "lang": "uk"}
+    cities = {city.id: city for user_cities in subscribers.values() for city in user_cities if city.id is not None}
+    texts = await asyncio.gather(*(get_current_weather(city, interactive=False) for city in cities.values()))
+    texts = dict(zip(cities, texts))
+    for user_id, user_cities in subscribers.items():
+        if not user_cities:
+            await outbox.post(user_id, bot.send_message, user_id, "Додайте улюблені міста через 'додати <місто>'.")
+        for city in user_cities:
+            text = texts.get(city.id) or format_current_weather(city.name, None)
+            await outbox.post(user_id, bot.send_message, user_id, text)
+
+# Чи є цей процес лідером планувальника зараз
+def is_leader():
+    return time.monotonic() < leader_until
+
+# Отримання й продовження оренди лідера; при втраті зв'язку з базою оренда просто спливає
+async def maintain_leadership():
+    global leader_until
+    while True:
+        started = time.monotonic()
         try:
-            response = requests.get(WEATHER_URL, params=params)
-            response.raise_for_status()
-            data = response.json()
-            temp = data["main"]["temp"]
-            description = data["weather"][0]["description"].lower()
-            if temp > 30 or temp < -10 or "сильний дощ" in description or "шторм" in description:
-                await bot.send_message(user_id, f"⚠️ Увага! Екстремальна погода в {city}: {temp}°C, {description}.")
-        except requests.RequestException:
+            if await storage.acquire_lease("scheduler", WORKER_ID, LEADER_LEASE_TTL):
+                became_leader = not is_leader()
+                leader_until = started + LEADER_LEASE_TTL
+                if became_leader:
+                    run_backfill_now()
+            else:
+                leader_until = 0.0
+        except sqlite3.Error:
             pass
+        await asyncio.sleep(LEADER_LEASE_TTL / 3)
+
+# Новий лідер одразу розпізнає старі улюблені міста, не чекаючи щогодинного запуску
+def run_backfill_now():
+    job = scheduler.get_job("backfill_favorites")
+    if job is not None:
+        job.modify(next_run_time=datetime.now())
+
+# Виконання запланованого завдання (лише на лідері, з обмеженням кількості одночасних завдань)
+async def run_job(coro_func, *args):
+    if not is_leader():
+        return
+    async with job_semaphore:
+        await coro_func(*args)
+
+# Щохвилинна перевірка слоту оповіщень: підписники поточного HH:MM шукаються за індексом,
+# тому при старті не потрібно створювати завдання для кожного слоту чи користувача.
+# Слот визначається першим кроком, у момент спрацювання тригера, і завдання не чекає на job_semaphore:
+# інакше зайняті довгими завданнями дозволи зсунули б слот на наступну хвилину, а цей слот пропав би
+@metrics.timed("job_seconds", job="notify_tick")
+async def notification_tick(bot):
+    slot = datetime.now().strftime("%H:%M")
+    if is_leader():
+        await send_notification(bot, slot)
+
+# Щохвилинне прогрівання кешу, щоб розсилки й кнопки улюблених міст обслуговувались без звернення до API.
+# Завантажуються лише записи, що не доживуть свіжими до потрібного моменту; фонові запити обмежені
+# фоновою часткою квоти, а при вичерпаній квоті чи розімкненому запобіжнику прогрівання зупиняється
+@metrics.timed("job_seconds", job="warm_cache")
+async def warm_cache():
+    slot = (datetime.now() + timedelta(minutes=WARM_AHEAD_MINUTES)).strftime("%H:%M")
+    # Для слоту потрібна лише поточна погода, свіжа на момент розсилки
+    slot_fresh_for = (WARM_AHEAD_MINUTES + 1) * 60
+    tasks = [("current", city_id, slot_fresh_for) for city_id in await storage.get_slot_city_ids([slot])]
+    for city_id in await storage.get_popular_city_ids(WARM_POPULAR_CITIES):
+        tasks.append(("current", city_id, 60))
+        tasks.append(("forecast", city_id, 60))
+    tasks = list(dict.fromkeys(tasks))
+
+    calls = 0
+    semaphore = asyncio.Semaphore(WARM_CONCURRENCY)
+    unavailable = False
+
+    async def prefetch(endpoint, city_id, fresh_for):
+        nonlocal calls, unavailable
+        async with semaphore:
+            if unavailable or calls >= WARM_MAX_CALLS:
+                return
+            # Місце в ліміті резервується до завантаження і повертається, якщо запис ще свіжий
+            calls += 1
+            try:
+                if not await weather_client.prefetch(endpoint, city_id, fresh_for):
+                    calls -= 1
+            except WeatherUnavailable:
+                unavailable = True
+            except WeatherClientError:
+                pass
+
+    await asyncio.gather(*(prefetch(*task) for task in tasks))
+
+# Події екстремальної погоди: назва -> умова над масивами температур і кодів погоди усіх міст
+EXTREME_WEATHER_RULES = {
+    "heat": lambda temps, codes: temps > EXTREME_HEAT,
+    "frost": lambda temps, codes: temps < EXTREME_FROST,
+    "heavy_rain": lambda temps, codes: np.isin(codes, HEAVY_RAIN_CODES),
+    "storm": lambda temps, codes: np.isin(codes, STORM_CODES),
+}
+
+# Перевірка екстремальної погоди: одна перевірка для всіх користувачів, кожне місто завантажується один раз
+@metrics.timed("job_seconds", job="alert_sweep")
+async def check_extreme_weather(bot):
+    subscriptions = await storage.get_alert_subscriptions()
+    cities = {city.id: city for user_cities in subscriptions.values() for city in user_cities}
+    if not cities:
+        return
+    payloads = await asyncio.gather(*(fetch_current_weather(city, interactive=False) for city in cities.values()))
+    observed = {city_id: conditions for city_id, conditions in zip(cities, payloads) if conditions is not None}
+    if not observed:
+        return
+    city_ids = list(observed)
+    temps = np.array([observed[city_id].temp for city_id in city_ids])
+    codes = np.array([observed[city_id].condition_code for city_id in city_ids])
+    events = {}
+    for event, rule in EXTREME_WEATHER_RULES.items():
+        for index in np.flatnonzero(rule(temps, codes)):
+            events.setdefault(city_ids[index], []).append(event)
+
+    active = [(user_id, city.id, event) for user_id, user_cities in subscriptions.items()
+              for city in user_cities for event in events.get(city.id, ())]
+    new_alerts = await storage.claim_alerts(active, set(city_ids))
+    recipients = sorted({(user_id, city_id) for user_id, city_id, _ in new_alerts})
+    for user_id, city_id in recipients:
+        conditions = observed[city_id]
+        await outbox.post(user_id, bot.send_message, user_id,
+                          f"⚠️ Увага! Екстремальна погода в {cities[city_id].name}: "
+                          f"{conditions.temp}°C, {conditions.description.lower()}.")
 
 # Клавіатура для вибору типу прогнозу
 def get_weather_keyboard():
@@ -288,18 +233,19 @@ def get_weather_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 # Клавіатура для улюблених міст
-def get_favorite_cities_keyboard(user_id):
-    cities = get_favorite_cities(user_id)
+async def get_favorite_cities_keyboard(user_id):
+    cities = await storage.get_favorite_cities(user_id)
     if not cities:
         return None
-    keyboard = [[InlineKeyboardButton(city, callback_data=f"city_{city}")] for city in cities]
+    keyboard = [[InlineKeyboardButton(city.name, callback_data=f"city_{city.name}")] for city in cities]
     keyboard.append([InlineKeyboardButton("Ввести вручну", callback_data="manual")])
     return InlineKeyboardMarkup(keyboard)
 
 # Обробка /start
+@metrics.timed("handler_seconds", handler="start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    keyboard = get_favorite_cities_keyboard(user_id)
+    keyboard = await get_favorite_cities_keyboard(user_id)
     if keyboard:
         await update.message.reply_text(
             "Оберіть улюблене місто або введіть нове (через кому):",
@@ -315,25 +261,30 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/alert on/off – сповіщення про екстремальну погоду\n"
             "додати <місто> – додати улюблене місто\n"
             "улюблені – список улюблених міст\n"
-            "/compare <місто1, місто2> – порівняти погоду"
+            "/compare <місто1, місто2, ...> – порівняти погоду"
         )
 
 # Обробка текстових повідомлень
 # Обробка текстових повідомлень
+@metrics.timed("handler_seconds", handler="handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     text = update.message.text.strip()
 
     if text.startswith("додати "):
-        city = text[7:].strip().title()
-        save_favorite_city(user_id, city)
-        await update.message.reply_text(f"Місто {city} додано до улюблених!")
+        name = text[7:].strip().title()
+        city = await city_index.resolve(name)
+        if city is None:
+            await update.message.reply_text(f"Не вдалося знайти місто {name}.")
+            return
+        await storage.save_favorite_city(user_id, city)
+        await update.message.reply_text(f"Місто {city.name} додано до улюблених!")
         return
 
     if text.lower() == "улюблені":
-        cities = get_favorite_cities(user_id)
+        cities = await storage.get_favorite_cities(user_id)
         if cities:
-            await update.message.reply_text(f"Ваші улюблені міста: {', '.join(cities)}")
+            await update.message.reply_text(f"Ваші улюблені міста: {', '.join(city.name for city in cities)}")
         else:
             await update.message.reply_text("У вас немає улюблених міст.")
         return
@@ -343,17 +294,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Введіть хоча б одне місто.")
         return
 
-    context.user_data["cities"] = cities
+    await storage.set_pending_cities(user_id, cities)
     await update.message.reply_text("Виберіть тип прогнозу:", reply_markup=get_weather_keyboard())  # Виправлено
 
 # Обробка кнопок
+@metrics.timed("handler_seconds", handler="handle_button")
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
 
     if query.data == "back":
-        keyboard = get_favorite_cities_keyboard(user_id)
+        keyboard = await get_favorite_cities_keyboard(user_id)
         if keyboard:
             await query.message.edit_text(
                 "Оберіть улюблене місто або введіть нове (через кому):",
@@ -361,13 +313,12 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             await query.message.edit_text("Введіть одне або кілька міст через кому.")
-        if "cities" in context.user_data:
-            del context.user_data["cities"]
+        await storage.clear_pending_cities(user_id)
         return
 
     if query.data.startswith("city_"):
         city = query.data[5:]
-        context.user_data["cities"] = [city]
+        await storage.set_pending_cities(user_id, [city])
         await query.message.edit_text(f"Обрано: {city}. Виберіть тип прогнозу:", reply_markup=get_weather_keyboard())
         return
 
@@ -375,27 +326,72 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.edit_text("Введіть одне або кілька міст через кому.")
         return
 
-    if "cities" not in context.user_data:
-        await query.message.edit_text("Спочатку введіть міста.")
+    request_type = query.data
+    if request_type not in ("current", "forecast"):
         return
 
-    cities = context.user_data["cities"]
-    for city in cities:
-        if query.data == "current":
-            result = get_current_weather(city)
-            save_request(user_id, city, "current")
-            await query.message.reply_text(result)
-        elif query.data == "forecast":
-            result, chart = get_forecast(city)
-            save_request(user_id, city, "forecast")
-            await query.message.reply_text(result)
+    # Вибір міст зберігається в базі, тож кнопку може обробити будь-який процес бота. Оновлення обробляються
+    # паралельно, тому вибір забирається одразу: повторне натискання не завантажить ті самі міста вдруге,
+    # а нові міста, введені під час завантаження, не будуть стерті після нього
+    names = await storage.take_pending_cities(user_id)
+    if not names:
+        await query.message.edit_text("Спочатку введіть міста.")
+        return
+    chat_id = query.message.chat_id
+    await outbox.post(chat_id, query.message.edit_text, "Введіть нові міста або скористайтеся іншими командами.",
+                      priority=PRIORITY_INTERACTIVE)
+
+    # Усі міста завантажуються паралельно, відповіді йдуть у порядку готовності. Для прогнозу кількох міст
+    # одразу надсилаються повідомлення-заглушки, і кожне редагується, щойно його місто готове; графіки йдуть
+    # одним альбомом. Поточна погода без графіків заглушок не має, щоб не витрачати ліміт повідомлень чату.
+    # Обробник чекає лише на заглушки (їхні повідомлення потрібні для редагування); решта лише ставиться
+    # в чергу відправлення, де порядок повідомлень чату зберігається
+    async def load(index, name):
+        try:
+            city = await resolve_city(name)
+            if request_type == "current":
+                return index, city, await get_current_weather(city), None
+            text, chart = await get_forecast(city)
+            return index, city, text, chart
+        except Exception:
+            failure = "погоду" if request_type == "current" else "прогноз"
+            return index, None, f"Не вдалося знайти {failure} для {name.strip().title()}.", None
+
+    tasks = [asyncio.ensure_future(load(index, name)) for index, name in enumerate(names)]
+    try:
+        placeholders = None
+        if request_type == "forecast" and len(names) > 1:
+            placeholders = await asyncio.gather(*(outbox.submit(chat_id, query.message.reply_text,
+                                                                f"⏳ Завантажую погоду для {name}...")
+                                                  for name in names))
+        charts = [None] * len(names)
+        for task in asyncio.as_completed(tasks):
+            index, city, text, chart = await task
+            if city is not None:
+                storage.save_request(user_id, city.name, request_type)
+            if placeholders:
+                await outbox.post(chat_id, placeholders[index].edit_text, text, priority=PRIORITY_INTERACTIVE)
+            else:
+                await outbox.post(chat_id, query.message.reply_text, text, priority=PRIORITY_INTERACTIVE)
             if chart:
-                await query.message.reply_photo(photo=io.BytesIO(base64.b64decode(chart)))
-    
-    await query.message.edit_text("Введіть нові міста або скористайтеся іншими командами.")
-    del context.user_data["cities"]
+                charts[index] = (city.name, chart)
+        await send_charts(chat_id, query.message, [chart for chart in charts if chart])
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Надсилання графіків альбомами (Telegram приймає до CHART_ALBUM_SIZE фото в одному альбомі)
+async def send_charts(chat_id, message, charts):
+    for start in range(0, len(charts), CHART_ALBUM_SIZE):
+        chunk = charts[start:start + CHART_ALBUM_SIZE]
+        if len(chunk) == 1:
+            await outbox.post(chat_id, message.reply_photo, photo=chunk[0][1], priority=PRIORITY_INTERACTIVE)
+        else:
+            media = [InputMediaPhoto(chart, caption=name) for name, chart in chunk]
+            await outbox.post(chat_id, message.reply_media_group, media=media, priority=PRIORITY_INTERACTIVE)
 
 # Обробка /notify
+@metrics.timed("handler_seconds", handler="notify")
 async def notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     args = context.args
@@ -410,33 +406,27 @@ async def notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not (0 <= hour <= 23 and 0 <= minute <= 59):
                 raise ValueError
             notify_time = f"{hour:02d}:{minute:02d}"
-            save_notification_time(user_id, notify_time)
-            scheduler.add_job(
-                send_notification,
-                CronTrigger(hour=hour, minute=minute),
-                args=[context, user_id, context.bot],
-                id=f"notify_{user_id}_{notify_time}"
-            )
+            await storage.save_notification_time(user_id, notify_time)
             await update.message.reply_text(f"Оповіщення встановлено на {notify_time}.")
         except ValueError:
             await update.message.reply_text(f"Невірний формат часу: {t}. Використовуйте HH:MM.")
 
 # Обробка /stopnotify
+@metrics.timed("handler_seconds", handler="stop_notify")
 async def stop_notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    times = get_notification_times(user_id)
+    times = await storage.get_notification_times(user_id)
     if not times:
         await update.message.reply_text("У вас немає активних оповіщень.")
         return
-    for t in times:
-        scheduler.remove_job(f"notify_{user_id}_{t}")
-    delete_notifications(user_id)
+    await storage.delete_notifications(user_id)
     await update.message.reply_text("Оповіщення вимкнено.")
 
 # Обробка /history
+@metrics.timed("handler_seconds", handler="history")
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    history = get_history(user_id)
+    history = await storage.get_history(user_id)
     if not history:
         await update.message.reply_text("Історія запитів порожня.")
         return
@@ -446,88 +436,133 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(response)
 
 # Обробка /alert
+@metrics.timed("handler_seconds", handler="alert")
 async def alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     if context.args and context.args[0].lower() == "on":
-        save_alert_setting(user_id, 1)
-        scheduler.add_job(
-            check_extreme_weather,
-            CronTrigger(hour="*/6"),
-            args=[context, user_id, context.bot],
-            id=f"alert_{user_id}"
-        )
+        await storage.save_alert_setting(user_id, 1)
         await update.message.reply_text("Сповіщення про екстремальну погоду увімкнено.")
     elif context.args and context.args[0].lower() == "off":
-        save_alert_setting(user_id, 0)
-        try:
-            scheduler.remove_job(f"alert_{user_id}")
-        except:
-            pass
+        await storage.save_alert_setting(user_id, 0)
         await update.message.reply_text("Сповіщення про екстремальну погоду вимкнено.")
     else:
         await update.message.reply_text("Використовуйте: /alert on або /alert off")
 
-# Обробка /compare
+# Обробка /compare: кілька міст, один запит на місто і рейтинг за температурою
+@metrics.timed("handler_seconds", handler="compare")
 async def compare(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     args = " ".join(context.args).split(",")
-    cities = [city.strip().title() for city in args if city.strip()]
-    if len(cities) != 2:
-        await update.message.reply_text("Введіть рівно два міста, наприклад: /compare Київ, Охтирка")
+    names = list(dict.fromkeys(city.strip().title() for city in args if city.strip()))
+    if not 2 <= len(names) <= COMPARE_MAX_CITIES:
+        await update.message.reply_text(
+            f"Введіть від 2 до {COMPARE_MAX_CITIES} міст через кому, наприклад: /compare Київ, Охтирка, Львів")
         return
-    
-    weather1 = get_current_weather(cities[0])
-    weather2 = get_current_weather(cities[1])
-    comparison = f"Порівняння погоди:\n\n{weather1}\n\n{weather2}\n\n"
-    
-    try:
-        params1 = {"q": cities[0], "appid": API_KEY, "units": "metric"}
-        params2 = {"q": cities[1], "appid": API_KEY, "units": "metric"}
-        temp1 = requests.get(WEATHER_URL, params=params1).json().get("main", {}).get("temp", 0)
-        temp2 = requests.get(WEATHER_URL, params=params2).json().get("main", {}).get("temp", 0)
-        
-        if temp1 > temp2:
-            comparison += f"У {cities[0]} тепліше! 🌞"
-        elif temp2 > temp1:
-            comparison += f"У {cities[1]} тепліше! 🌞"
+
+    cities = await asyncio.gather(*(resolve_city(name) for name in names))
+    payloads = await asyncio.gather(*(fetch_current_weather(city) for city in cities))
+    comparison = "Порівняння погоди:\n\n"
+    comparison += "\n\n".join(format_current_weather(city.name, conditions)
+                                for city, conditions in zip(cities, payloads))
+
+    ranking = sorted(((conditions.temp, city.name) for city, conditions in zip(cities, payloads)
+                      if conditions is not None), reverse=True)
+    if len(ranking) < 2:
+        comparison += "\n\nНе вдалося порівняти температури."
+    else:
+        comparison += "\n\n🏆 Рейтинг за температурою:\n"
+        comparison += "\n".join(f"{place}. {city} — {temp:.1f}°C {get_temp_emoji(temp)}"
+                                 for place, (temp, city) in enumerate(ranking, start=1))
+        if ranking[0][0] == ranking[-1][0]:
+            comparison += "\n\nТемпература однакова! 😊"
         else:
-            comparison += "Температура однакова! 😊"
-    except:
-        comparison += "Не вдалося порівняти температури."
-    
-    save_request(user_id, cities[0], "compare")
-    save_request(user_id, cities[1], "compare")
+            comparison += f"\n\nУ {ranking[0][1]} найтепліше! 🌞"
+
+    for city in cities:
+        storage.save_request(user_id, city.name, "compare")
     await update.message.reply_text(comparison)
 
-# Завантаження запланованих завдань
+# Запізнення запуску завдання відносно розкладу (метрика scheduler_job_lag_seconds)
+def record_job_lag(event):
+    for run_time in event.scheduled_run_times:
+        lag = (datetime.now(run_time.tzinfo) - run_time).total_seconds()
+        metrics.observe("scheduler_job_lag_seconds", lag, job=event.job_id)
+
+# Завантаження запланованих завдань: фіксований набір, не залежить від кількості підписників
 def load_scheduled_jobs(application):
-    conn = sqlite3.connect("/app/data/weather_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT user_id, notify_time FROM notifications")
-    for user_id, notify_time in c.fetchall():
-        hour, minute = map(int, notify_time.split(":"))
-        scheduler.add_job(
-            send_notification,
-            CronTrigger(hour=hour, minute=minute),
-            args=[None, user_id, application.bot],
-            id=f"notify_{user_id}_{notify_time}"
-        )
-    c.execute("SELECT user_id FROM alerts WHERE enabled = 1")
-    for (user_id,) in c.fetchall():
-        scheduler.add_job(
-            check_extreme_weather,
-            CronTrigger(hour="*/6"),
-            args=[None, user_id, application.bot],
-            id=f"alert_{user_id}"
-        )
-    conn.close()
+    if metrics.METRICS_ENABLED:
+        scheduler.add_listener(record_job_lag, EVENT_JOB_SUBMITTED)
+    # Розсилка великого слоту може тривати довше хвилини; наступні слоти не повинні пропускатися
+    scheduler.add_job(
+        notification_tick,
+        CronTrigger(minute="*"),
+        args=[application.bot],
+        id="notify_tick",
+        max_instances=5,
+        replace_existing=True
+    )
+    scheduler.add_job(
+        run_job,
+        CronTrigger(hour="*/6"),
+        args=[check_extreme_weather, application.bot],
+        id="alert_sweep",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        run_job,
+        CronTrigger(minute="*", second=30),
+        args=[warm_cache],
+        id="warm_cache",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        run_job,
+        CronTrigger(minute=17),
+        args=[storage.compact_requests],
+        id="compact_requests",
+        replace_existing=True
+    )
+    # Старі улюблені міста, які не вдалося розпізнати (API недоступний чи квоту вичерпано), пробуємо щогодини
+    scheduler.add_job(
+        run_job,
+        CronTrigger(minute=47),
+        args=[city_index.backfill_favorites],
+        id="backfill_favorites",
+        replace_existing=True
+    )
 
-# Головна функція
-def main():
-    global application
-    init_db()
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN", "your_telegram_bot_token")
-    application = Application.builder().token(bot_token).build()
+# Запуск і зупинка спільного HTTP-клієнта та бази даних разом із ботом
+async def on_startup(application):
+    global job_semaphore, request_log_task, leader_task
+    job_semaphore = asyncio.Semaphore(SCHEDULER_MAX_JOBS)
+    await weather_client.start()
+    await outbox.start()
+    await city_index.load()
+    request_log_task = asyncio.create_task(storage.flush_requests_periodically())
+    leader_task = asyncio.create_task(maintain_leadership())
+    await metrics.start_server()
+    scheduler.start()
+    print(f"Бот готовий до роботи за {time.perf_counter() - STARTED_AT:.2f} с")
+
+async def on_shutdown(application):
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    request_log_task.cancel()
+    leader_task.cancel()
+    # Звільняємо оренду, щоб інший процес перебрав розклад одразу, а не після її закінчення
+    await storage.release_lease("scheduler", WORKER_ID)
+    await metrics.stop_server()
+    await outbox.close()
+    await weather_client.close()
+    await storage.close_db()
+
+# Створення застосунку з усіма обробниками (base_url дозволяє підставити локальну заглушку Bot API)
+def build_application(bot_token, base_url=None):
+    builder = (Application.builder().token(bot_token).concurrent_updates(CONCURRENT_UPDATES)
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("notify", notify))
@@ -537,7 +572,14 @@ def main():
     application.add_handler(CommandHandler("compare", compare))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(handle_button))
+    return application
 
+# Головна функція
+def main():
+    global application
+    storage.init_db.blocking()
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN", "your_telegram_bot_token")
+    application = build_application(bot_token)
     load_scheduled_jobs(application)
 
     webhook_url = os.getenv("WEBHOOK_URL", "https://your-render-service.onrender.com/webhook")
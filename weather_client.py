@@ -0,0 +1,398 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+
+import httpx
+
+import metrics
+import storage
+from models import CurrentConditions, Forecast
+
+# Налаштування OpenWeatherMap API (OWM_BASE_URL дозволяє підставити локальну заглушку)
+API_KEY = os.getenv("OPENWEATHER_API_KEY", "your_openweather_api_key")
+OWM_BASE_URL = os.getenv("OWM_BASE_URL", "http://api.openweathermap.org").rstrip("/")
+WEATHER_URL = f"{OWM_BASE_URL}/data/2.5/weather"
+FORECAST_URL = f"{OWM_BASE_URL}/data/2.5/forecast"
+
+# Обмеження пулу з'єднань і часу очікування
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OWM_MAX_CONCURRENCY", 50))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OWM_MAX_KEEPALIVE", 20))
+REQUEST_TIMEOUT = float(os.getenv("OWM_TIMEOUT", 10))
+CONNECT_TIMEOUT = float(os.getenv("OWM_CONNECT_TIMEOUT", 5))
+
+# Налаштування кешу відповідей; після TTL запис ще STALE_TTL секунд віддається як застарілий,
+# поки у фоні завантажується свіжий
+CURRENT_TTL = float(os.getenv("CURRENT_WEATHER_TTL", 600))
+FORECAST_TTL = float(os.getenv("FORECAST_TTL", 1800))
+STALE_TTL = float(os.getenv("WEATHER_STALE_TTL", 3 * 3600))
+CACHE_MAX_BYTES = int(os.getenv("WEATHER_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+# Спільний кеш у SQLite для кількох процесів бота: промах у пам'яті спершу шукається в базі
+SHARED_WEATHER_CACHE = os.getenv("SHARED_WEATHER_CACHE", "0").lower() in ("1", "true", "yes")
+
+# Типи запитів: адреса, час свіжості в кеші та модель відповіді
+ENDPOINTS = {
+    "current": (WEATHER_URL, CURRENT_TTL, CurrentConditions),
+    "forecast": (FORECAST_URL, FORECAST_TTL, Forecast),
+}
+
+# Стійкість до збоїв: повтори з випадковою затримкою та запобіжник для кожного типу запиту
+MAX_RETRIES = int(os.getenv("OWM_MAX_RETRIES", 2))
+RETRY_BACKOFF = float(os.getenv("OWM_RETRY_BACKOFF", 0.5))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("OWM_BREAKER_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv("OWM_BREAKER_RESET", 30))
+
+# Квота API; фонові запити (розсилки, перевірки) можуть використати лише частину квоти
+CALLS_PER_MINUTE = int(os.getenv("OWM_CALLS_PER_MINUTE", 60))
+CALLS_PER_DAY = int(os.getenv("OWM_CALLS_PER_DAY", 30000))
+BACKGROUND_QUOTA_SHARE = float(os.getenv("OWM_BACKGROUND_SHARE", 0.7))
+
+
+# Помилка звернення до OpenWeatherMap (status — HTTP-код відповіді, якщо він є)
+class WeatherClientError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    # Мережеві збої, тайм-аути, 429 і 5xx варто повторити; 4xx (наприклад, 404) — ні
+    @property
+    def retryable(self):
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+# Запит не виконано без звернення до API: розімкнений запобіжник або вичерпана квота
+class WeatherUnavailable(WeatherClientError):
+    pass
+
+
+# Нормалізація назви міста для пошуку в індексі міст
+def normalize_city(city):
+    return " ".join(city.split()).casefold()
+
+
+# LRU-кеш із TTL, віддачею застарілих даних під час оновлення (stale-while-revalidate)
+# та об'єднанням однакових запитів (single-flight)
+class TTLCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, stale_ttl=STALE_TTL):
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (fresh_until, stale_until, size, value)
+        self._inflight = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+        self.evictions = 0
+
+    # Повертає (value, fresh) або None
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[1] < now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[3], entry[0] >= now
+
+    def set(self, key, value, ttl, size):
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        self._entries[key] = (now + ttl, now + ttl + self.stale_ttl, size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    # Скільки секунд запис ще буде свіжим (від'ємне значення — вже застарів, -inf — запису немає)
+    def fresh_for(self, key):
+        entry = self._entries.get(key)
+        return entry[0] - time.monotonic() if entry is not None else float("-inf")
+
+    # Примусове оновлення запису (разом з іншими одночасними завантаженнями того ж ключа)
+    def refresh(self, key, fetch):
+        return self._start_load(key, fetch)
+
+    # Повертає значення з кешу або завантажує його один раз для всіх одночасних запитів
+    # (fetch повертає (value, size, ttl)). Застаріле значення повертається одразу, а оновлення запускається у фоні
+    async def get_or_fetch(self, key, fetch):
+        cached = self.get(key)
+        if cached is not None:
+            value, fresh = cached
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                self._start_load(key, fetch).add_done_callback(_consume_exception)
+            return value
+        if key in self._inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        # shield: скасування одного з очікувачів не скасовує спільне завантаження
+        return await asyncio.shield(self._start_load(key, fetch))
+
+    def _start_load(self, key, fetch):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def _load(self, key, fetch):
+        value, size, ttl = await fetch()
+        self.set(key, value, ttl, size)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "shared_hits": self.shared_hits,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hit_ratio": (self.hits + self.stale_hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+def _consume_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+# Запобіжник: після кількох збоїв поспіль запити не надсилаються reset_timeout секунд,
+# потім пропускається один пробний запит
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    # Пробний запит не дійшов до API (вичерпана квота, скасування): запобіжник знову розімкнений,
+    # наступна спроба — через reset_timeout
+    def abort_probe(self):
+        if self.state == "half_open":
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+# Бюджет звернень до API за хвилину і за добу (UTC)
+class QuotaBudget:
+    def __init__(self, per_minute=CALLS_PER_MINUTE, per_day=CALLS_PER_DAY, background_share=BACKGROUND_QUOTA_SHARE):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.background_share = background_share
+        self._minute = self._day = None
+        self.minute_calls = self.day_calls = 0
+
+    def try_acquire(self, interactive=True):
+        now = time.time()
+        minute, day = int(now // 60), int(now // 86400)
+        if minute != self._minute:
+            self._minute, self.minute_calls = minute, 0
+        if day != self._day:
+            self._day, self.day_calls = day, 0
+        share = 1.0 if interactive else self.background_share
+        if self.minute_calls >= self.per_minute * share or self.day_calls >= self.per_day * share:
+            return False
+        self.minute_calls += 1
+        self.day_calls += 1
+        return True
+
+
+# Спільний асинхронний клієнт OpenWeatherMap
+class WeatherClient:
+    def __init__(self, max_concurrency=MAX_CONCURRENT_REQUESTS, timeout=REQUEST_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, max_keepalive=MAX_KEEPALIVE_CONNECTIONS,
+                 cache=None, budget=None, transport=None):
+        self.max_concurrency = max_concurrency
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_concurrency,
+                                   max_keepalive_connections=max_keepalive)
+        self.transport = transport
+        self.cache = cache if cache is not None else TTLCache()
+        self.budget = budget if budget is not None else QuotaBudget()
+        self.breakers = {"current": CircuitBreaker(), "forecast": CircuitBreaker()}
+        self._client = None
+        self._semaphore = None
+
+    # Клієнт і семафор створюються ліниво, вже всередині циклу подій бота
+    def _ensure_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, transport=self.transport)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def start(self):
+        self._ensure_client()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._semaphore = None
+
+    # Повертає розібраний JSON і сире тіло відповіді (його розмір іде в ліміт пам'яті кешу)
+    async def get_json(self, url, params):
+        client = self._ensure_client()
+        try:
+            async with self._semaphore:
+                response = await client.get(url, params=params)
+            response.raise_for_status()
+            return response.json(), response.content
+        except httpx.HTTPStatusError as e:
+            raise WeatherClientError(str(e), status=e.response.status_code) from e
+        except (httpx.HTTPError, ValueError) as e:
+            raise WeatherClientError(str(e)) from e
+
+    # Запит через запобіжник і квоту з повторами після тимчасових збоїв
+    async def _request(self, endpoint, url, params, interactive):
+        breaker = self.breakers[endpoint]
+        for attempt in range(MAX_RETRIES + 1):
+            if not breaker.allow():
+                raise WeatherUnavailable(f"Circuit breaker for {endpoint} is open")
+            if not self.budget.try_acquire(interactive):
+                breaker.abort_probe()
+                raise WeatherUnavailable("OpenWeatherMap call budget exhausted")
+            try:
+                with metrics.timer("owm_request_seconds", endpoint=endpoint):
+                    result = await self.get_json(url, params)
+            except WeatherClientError as e:
+                if not e.retryable:
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+            except BaseException:
+                # Скасування чи непередбачена помилка: результат пробного запиту невідомий
+                breaker.abort_probe()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    # Завантаження й розбір відповіді в модель; у кеші зберігаються вже розібрані об'єкти
+    async def _fetch_model(self, endpoint, url, params, model, ttl, interactive):
+        data, body = await self._request(endpoint, url, params, interactive)
+        fetched_at = int(time.time())
+        try:
+            value = model.from_owm(data, fetched_at=fetched_at)
+        except (KeyError, IndexError, TypeError) as e:
+            raise WeatherClientError(f"Unexpected response format: {e!r}") from e
+        if SHARED_WEATHER_CACHE:
+            try:
+                await storage.save_cached_weather(endpoint, value.city_id, params["lang"], fetched_at,
+                                                  int(fetched_at + ttl), body)
+            except sqlite3.Error:
+                pass
+        return value, len(body), ttl
+
+    # Свіжа відповідь зі спільного кешу (її міг завантажити інший процес) або None
+    async def _fetch_shared(self, endpoint, city_id, lang, model):
+        try:
+            row = await storage.get_cached_weather(endpoint, city_id, lang)
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        fetched_at, expires_at, body = row
+        try:
+            value = model.from_owm(json.loads(body), fetched_at=fetched_at)
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+        self.cache.shared_hits += 1
+        return value, len(body), expires_at - time.time()
+
+    # Функція завантаження для кешу: спершу спільний кеш (якщо увімкнений), потім API
+    def _fetcher(self, endpoint, city_id, lang, interactive):
+        url, ttl, model = ENDPOINTS[endpoint]
+        params = {"id": city_id, "appid": API_KEY, "units": "metric", "lang": lang}
+
+        async def fetch():
+            if SHARED_WEATHER_CACHE:
+                shared = await self._fetch_shared(endpoint, city_id, lang, model)
+                if shared is not None:
+                    return shared
+            return await self._fetch_model(endpoint, url, params, model, ttl, interactive)
+
+        return fetch
+
+    async def _cached(self, endpoint, city_id, lang, interactive):
+        return await self.cache.get_or_fetch((endpoint, city_id, lang),
+                                             self._fetcher(endpoint, city_id, lang, interactive))
+
+    # Поточна погода за ідентифікатором міста OpenWeatherMap (CurrentConditions);
+    # interactive=False для фонових завдань, щоб вони не витратили квоту відповідей користувачам
+    async def current(self, city_id, lang="uk", interactive=True):
+        return await self._cached("current", city_id, lang, interactive)
+
+    # Прогноз на 5 днів з кроком 3 години за ідентифікатором міста (Forecast)
+    async def forecast(self, city_id, lang="uk", interactive=True):
+        return await self._cached("forecast", city_id, lang, interactive)
+
+    # Фонове попереднє завантаження: оновлює запис ("current" або "forecast"), якщо він залишатиметься
+    # свіжим менше ніж fresh_for секунд. Повертає True, якщо було завантаження
+    async def prefetch(self, endpoint, city_id, fresh_for=0.0, lang="uk"):
+        key = (endpoint, city_id, lang)
+        if self.cache.fresh_for(key) >= fresh_for:
+            return False
+        await asyncio.shield(self.cache.refresh(key, self._fetcher(endpoint, city_id, lang, False)))
+        return True
+
+    # Пошук міста за назвою (лише коли його немає в локальному індексі міст);
+    # отримана погода одразу кладеться в кеш за ідентифікатором міста
+    async def lookup(self, name, lang="uk", interactive=True):
+        params = {"q": name, "appid": API_KEY, "units": "metric", "lang": lang}
+        conditions, size, _ = await self._fetch_model("current", WEATHER_URL, params, CurrentConditions, CURRENT_TTL,
+                                                      interactive)
+        self.cache.set(("current", conditions.city_id, lang), conditions, CURRENT_TTL, size)
+        return conditions
+
+
+weather_client = WeatherClient()
+metrics.gauge("weather_cache_hit_ratio", "Частка запитів погоди, обслужених з кешу",
+              lambda: weather_client.cache.stats()["hit_ratio"])
+metrics.gauge("weather_cache_bytes", "Розмір кешу відповідей OpenWeatherMap у байтах",
+              lambda: weather_client.cache.bytes)